@@ -0,0 +1,332 @@
+"""Data loading for the Analytics module."""
+import threading
+from dataclasses import dataclass
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+import sheets_client
+import snapshot_store
+
+# Columns of each worksheet used by the dashboard
+SHEET_COLUMNS = {
+    "Restrictions": ['ID', 'Дата', 'Время начала', 'Время конца', 'Тип', 'Объем, МВт'],
+    "Spravka": ['day', 'object', 'type', 'plan', 'fact'],
+    "Pogoda": ['day', 'city', 'temperature_2m'],
+}
+
+# Declared types of the ingested columns, applied once when the sheets are loaded
+SCHEMA = {
+    "Restrictions": {
+        'Дата': 'date_dmy',
+        'Время начала': 'minutes',
+        'Время конца': 'minutes',
+        'Тип': 'category',
+        'Объем, МВт': 'float32',
+    },
+    "Spravka": {'day': 'date', 'object': 'category', 'type': 'category', 'plan': 'float32', 'fact': 'float32'},
+    "Pogoda": {'day': 'date', 'city': 'category', 'temperature_2m': 'float32'},
+}
+
+# Worksheets that only grow by appending new days at the bottom
+APPEND_ONLY_SHEETS = ("Spravka", "Pogoda")
+
+# Already synced rows re-read on every incremental sync (recent days may still be corrected)
+SYNC_OVERLAP_ROWS = 200
+
+# Most points per series a chart gets; longer windows are aggregated or downsampled
+POINT_BUDGET = 92
+
+if int(pd.__version__.split('.')[0]) < 3:
+    # Slices of the shared frames must not write through to them (always on from pandas 3)
+    pd.set_option('mode.copy_on_write', True)
+
+_sync_lock = threading.RLock()
+_sync_state = {}  # worksheet title -> {'rows': [...]}
+_held = {'revision': None, 'synced': False, 'saved_at': None}
+_reconcile_thread = None
+
+
+def _sync(incremental):
+    """Bring the process-wide copy of the sheets up to date.
+
+    Restrictions is small and edited in place, so it is always re-read in full.
+    Spravka and Pogoda are append-only: only the rows after the last ones seen
+    are downloaded. The last SYNC_OVERLAP_ROWS rows are re-read as well to pick
+    up late corrections, and if the first of them no longer matches (rows were
+    inserted or removed above it) the sheet is downloaded again in full.
+    """
+    first_rows = {}
+    kept = {}
+    for title in APPEND_ONLY_SHEETS:
+        state = _sync_state.get(title)
+        if incremental and state and state['rows']:
+            kept[title] = max(len(state['rows']) - SYNC_OVERLAP_ROWS, 0)
+            # Header is row 1, so data row i (0-based) is sheet row i + 2
+            first_rows[title] = kept[title] + 2
+
+    data = sheets_client.batch_get_columns(SHEET_COLUMNS, first_rows)
+
+    stale = []
+    for title in APPEND_ONLY_SHEETS:
+        rows = data[title][1:]
+        if title in first_rows:
+            state = _sync_state[title]
+            if rows and rows[0] == state['rows'][kept[title]]:
+                state['rows'][kept[title]:] = rows
+            else:
+                stale.append(title)
+                continue
+        else:
+            _sync_state[title] = {'rows': rows}
+
+    if stale:
+        for title in stale:
+            del _sync_state[title]
+        return _sync(incremental=False)
+
+    _sync_state["Restrictions"] = {'rows': data["Restrictions"][1:]}
+
+
+def _frames():
+    # Convert to DataFrames
+    return tuple(
+        pd.DataFrame(_sync_state[title]['rows'], columns=columns)
+        for title, columns in SHEET_COLUMNS.items()
+    )
+
+
+def _restore_snapshot():
+    """Seed the in-memory copy from the local snapshots, if all of them are present."""
+    try:
+        snapshots = {title: snapshot_store.load(title) for title in SHEET_COLUMNS}
+    except Exception:
+        # A corrupt snapshot is ignored, the data is synced from the sheet instead
+        return
+    if any(snapshot is None for snapshot in snapshots.values()):
+        return
+    revisions = {revision for _, revision, _ in snapshots.values()}
+    if len(revisions) != 1:
+        # Snapshots from different revisions: sync fully rather than mixing them
+        return
+    if any(list(dataframe.columns) != SHEET_COLUMNS[title] for title, (dataframe, _, _) in snapshots.items()):
+        return
+    for title, (dataframe, _, _) in snapshots.items():
+        _sync_state[title] = {'rows': dataframe.values.tolist()}
+    _held['revision'] = revisions.pop()
+    _held['saved_at'] = min(saved_at for _, _, saved_at in snapshots.values())
+
+
+def _save_snapshot(frames, revision):
+    try:
+        for title, dataframe in zip(SHEET_COLUMNS, frames):
+            snapshot_store.save(title, dataframe, revision)
+    except OSError:
+        # The snapshot is only an optimization, the app works without it
+        pass
+
+
+def _to_minutes(series):
+    """Parse 'ЧЧ:ММ' strings to minutes since midnight (NaN if unparseable)."""
+    parts = series.astype(str).str.extract(r'^\s*(\d{1,2}):(\d{2})')
+    return (pd.to_numeric(parts[0]) * 60 + pd.to_numeric(parts[1])).astype('float32')
+
+
+_CONVERTERS = {
+    'date': lambda series: pd.to_datetime(series, errors='coerce').dt.normalize(),
+    'date_dmy': lambda series: pd.to_datetime(series, format='%d.%m.%Y', errors='coerce'),
+    'category': lambda series: series.astype('category'),
+    'float32': lambda series: pd.to_numeric(series, errors='coerce').astype('float32'),
+    'minutes': _to_minutes,
+}
+
+
+def apply_schema(title, dataframe):
+    """Convert the string columns of a worksheet to the types declared in SCHEMA."""
+    return dataframe.assign(**{
+        column: _CONVERTERS[kind](dataframe[column])
+        for column, kind in SCHEMA[title].items()
+    })
+
+
+def format_minutes(series):
+    """Format minutes since midnight back to 'ЧЧ:ММ' strings."""
+    minutes = series.astype('Int64')
+    return (minutes // 60).astype(str).str.zfill(2) + ':' + (minutes % 60).astype(str).str.zfill(2)
+
+
+def process_data(df_1, df_2, df_3):
+    """Process typed data into a daily facts table and a restriction events table.
+
+    The daily table has one row per day with the pivoted Spravka and Pogoda
+    values; the events table has one row per restriction. They are kept
+    apart so days with several restrictions are not duplicated. Both are
+    indexed by a sorted DatetimeIndex named 'day', so date ranges can be taken
+    with ``.loc[start:end]`` (binary search) and days looked up directly.
+    """
+    # Pivot df_2; min_count keeps days without values as NaN instead of 0
+    df_2_pivot = (
+        df_2.groupby(['day', 'object', 'type'], observed=True)[['plan', 'fact']]
+        .sum(min_count=1)
+        .unstack(['object', 'type'])
+    )
+    df_2_pivot.columns = ['_'.join(col).strip() for col in df_2_pivot.columns]
+
+    # Pivot df_3 (duplicate readings for a city and day are averaged)
+    df_3_pivot = (
+        df_3.groupby(['day', 'city'], observed=True)['temperature_2m']
+        .mean()
+        .unstack('city')
+    )
+    df_3_pivot.columns = df_3_pivot.columns.astype(str)
+
+    # The wide daily table is small; keep it float64 for charts and model fitting
+    daily = df_3_pivot.join(df_2_pivot, how='outer').astype('float64')
+    daily = daily[daily.index.notna()].sort_index()
+
+    # Select specific columns from df_1
+    columns_to_select = ['Дата', 'Время начала', 'Время конца', 'Тип', 'Объем, МВт']
+    events = (
+        df_1[columns_to_select]
+        .rename(columns={'Дата': 'day'})
+        .dropna(subset=['day'])
+        .sort_values(['day', 'Время начала'])
+        .set_index('day')
+    )
+
+    return daily, events
+
+
+@dataclass(frozen=True)
+class AnalyticsDataset:
+    """Processed data of one spreadsheet revision, held once per process.
+
+    The same object is shared read-only by every session: the frames must
+    not be modified in place. Slices taken from them are lazy copies
+    (copy-on-write), so filtering a window does not copy the base data.
+    """
+    revision: str
+    daily: pd.DataFrame
+    events: pd.DataFrame
+    forecasts: pd.DataFrame
+
+    def window(self, start, end):
+        """Daily rows and restriction events from ``start`` to ``end`` (inclusive)."""
+        return self.daily.loc[start:end], self.events.loc[start:end]
+
+    @cached_property
+    def weekly(self):
+        """Weekly means of the daily table, indexed by the Monday of each week (computed once)."""
+        return _period_means(self.daily, 'W')
+
+    @cached_property
+    def monthly(self):
+        """Monthly means of the daily table, indexed by the first day of each month (computed once)."""
+        return _period_means(self.daily, 'M')
+
+    def chart_window(self, start, end, budget=POINT_BUDGET):
+        """Daily table of a window at a resolution that fits ``budget`` points.
+
+        Returns ``(frame, resolution)``: the daily rows ('D') while the window
+        has at most ``budget`` days, otherwise the weekly ('W') or, if those
+        are still too many, the monthly ('M') means of the periods overlapping
+        the window.
+        """
+        days = (end - start).days + 1
+        if days <= budget:
+            return self.daily.loc[start:end], 'D'
+        resolution, table = ('W', self.weekly) if days / 7 <= budget else ('M', self.monthly)
+        return table.loc[start.to_period(resolution).start_time:end], resolution
+
+
+def _period_means(daily, freq):
+    means = daily.groupby(daily.index.to_period(freq).start_time).mean()
+    return means.rename_axis('day')
+
+
+def lttb(x, y, threshold=POINT_BUDGET):
+    """Positions of the points kept by Largest-Triangle-Three-Buckets downsampling.
+
+    Keeps the first and last point and, from each of ``threshold - 2``
+    buckets, the point forming the largest triangle with the previously kept
+    point and the average of the next bucket, so peaks and troughs survive.
+    """
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    bucket = (n - 2) / (threshold - 2)
+    kept = np.empty(threshold, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        next_end = min(int((i + 2) * bucket) + 1, n)
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        kept[i + 1] = previous
+    return kept
+
+
+def local_revision():
+    """Revision of the data held in this process (restored from the snapshot at startup)."""
+    with _sync_lock:
+        if not _sync_state:
+            _restore_snapshot()
+        return _held['revision']
+
+
+def is_synced():
+    """Whether the held data has been synced with Google Sheets in this process."""
+    return _held['synced']
+
+
+def snapshot_time():
+    """Time the snapshot restored at startup was saved, as a Unix timestamp."""
+    return _held['saved_at']
+
+
+def load_sheets(revision=None, incremental=True):
+    """Return the Restrictions, Spravka and Pogoda worksheets as typed DataFrames.
+
+    If ``revision`` matches the data already held in this process (synced
+    earlier or restored from the local snapshot) no API call is made.
+    """
+    with _sync_lock:
+        if not _sync_state:
+            _restore_snapshot()
+        if revision is None or revision != _held['revision'] or not _sync_state:
+            _sync(incremental)
+            frames = _frames()
+            _held.update(revision=revision, synced=True)
+            if revision is not None:
+                _save_snapshot(frames, revision)
+        else:
+            frames = _frames()
+    return tuple(apply_schema(title, frame) for title, frame in zip(SHEET_COLUMNS, frames))
+
+
+def reconcile_in_background(revision):
+    """Sync with Google Sheets on a background thread, e.g. while the snapshot is served."""
+    global _reconcile_thread
+    with _sync_lock:
+        if _reconcile_thread is not None and _reconcile_thread.is_alive():
+            return
+
+        def reconcile():
+            try:
+                load_sheets(revision)
+            except Exception:
+                # The next page load syncs in the foreground and reports the error
+                pass
+
+        _reconcile_thread = threading.Thread(target=reconcile, name="sheets-reconcile", daemon=True)
+        _reconcile_thread.start()
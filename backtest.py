@@ -0,0 +1,158 @@
+"""Rolling-origin backtest of ARIMA orders on the Spravka history.
+
+For every pivoted Spravka series, each order of the grid is evaluated by
+fitting on the history up to a forecast origin and comparing the next
+``horizon`` days with the actual values, for several origins going back
+from the last observed day. The consumption and load series are evaluated
+with the same temperature regressors as in forecasting.forecast_table
+(ARIMAX), so their orders are chosen for the model that is deployed.
+Evaluations run in parallel across cores. The order with the lowest MAE per
+series is saved to forecasting.ORDERS_PATH, where the live forecasts pick
+it up.
+
+Usage:
+    python backtest.py [--origins 8] [--horizon 5] [--workers N] [--series TEXT] [--dry-run]
+"""
+import argparse
+import itertools
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.arima.model import ARIMA
+
+import forecasting
+
+# ARIMA orders evaluated for every series
+ORDER_GRID = [(p, d, q) for p, d, q in itertools.product((0, 1, 2), (0, 1), (0, 1, 2)) if p or q]
+
+# Days between consecutive forecast origins
+ORIGIN_SPACING = 7
+
+
+def evaluate_order(values, order, origins, horizon, exog=None):
+    """Rolling-origin errors and fit time of one order on one series; runs in a worker process.
+
+    ``exog`` is the optional regressor matrix aligned with ``values``; the
+    forecasts use its rows of the forecast days, as the live forecasts use
+    the temperatures Pogoda already has for them.
+    """
+    errors, actuals, fit_seconds, failures = [], [], [], 0
+    for origin in origins:
+        started = time.perf_counter()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                if exog is None:
+                    results = ARIMA(values[:origin], order=order).fit()
+                    forecast = results.forecast(steps=horizon)
+                else:
+                    results = ARIMA(values[:origin], exog=exog[:origin], order=order).fit()
+                    future = exog[origin:origin + horizon]
+                    forecast = results.forecast(steps=len(future), exog=future)
+        except Exception:
+            failures += 1
+            continue
+        fit_seconds.append(time.perf_counter() - started)
+        actual = values[origin:origin + horizon]
+        errors.append(forecast[:len(actual)] - actual)
+        actuals.append(actual)
+
+    if not errors:
+        return {'mae': np.nan, 'mape': np.nan, 'fit_s': np.nan, 'failures': failures}
+    errors = np.concatenate(errors)
+    actuals = np.concatenate(actuals)
+    nonzero = actuals != 0
+    return {
+        'mae': float(np.mean(np.abs(errors))),
+        'mape': float(np.mean(np.abs(errors[nonzero] / actuals[nonzero])) * 100) if nonzero.any() else np.nan,
+        'fit_s': float(np.mean(fit_seconds)),
+        'failures': failures,
+    }
+
+
+def forecast_origins(n_obs, n_origins, horizon, spacing=ORIGIN_SPACING):
+    """Origins (training lengths) going back from the end of a series of ``n_obs`` points."""
+    last = n_obs - horizon
+    return [origin for origin in range(last, last - n_origins * spacing, -spacing) if origin > 30][::-1]
+
+
+def run_backtest(daily, orders=ORDER_GRID, n_origins=8, horizon=5, workers=None, series_filter=None, weather=True):
+    """Evaluate the order grid on every series; returns one row per series and order.
+
+    With ``weather`` the WEATHER_TYPES series get the temperature regressors,
+    as in forecasting.forecast_table.
+    """
+    history = daily.loc[forecasting.TRAINING_START:]
+    names = [
+        name for name in forecasting.discover_series(daily)
+        if series_filter is None or series_filter in name
+    ]
+    design = None
+    if weather and any(city in daily.columns for city in forecasting.TEMPERATURE_CITIES):
+        design = forecasting.temperature_design(history)
+
+    tasks = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for name in names:
+            frame = history[name].rename('y').to_frame()
+            if design is not None and forecasting.split_series_name(name)[2].startswith(forecasting.WEATHER_TYPES):
+                frame = frame.join(design, how='left')
+            # Days without regressor values are left out, as in the live fits
+            frame = frame.dropna()
+            values = frame['y'].to_numpy(dtype=float)
+            exog = frame.drop(columns='y').to_numpy(dtype=float) if frame.shape[1] > 1 else None
+            origins = forecast_origins(len(values), n_origins, horizon)
+            if not origins:
+                continue
+            for order in orders:
+                tasks[name, order] = pool.submit(evaluate_order, values, order, origins, horizon, exog)
+
+        rows = []
+        for (name, order), future in tasks.items():
+            rows.append({'series': name, 'order': order, **future.result()})
+    return pd.DataFrame(rows, columns=['series', 'order', 'mae', 'mape', 'fit_s', 'failures'])
+
+
+def best_orders(report):
+    """Order with the lowest MAE for every series, ties broken by fit time."""
+    ranked = report.dropna(subset=['mae']).sort_values(['series', 'mae', 'fit_s'])
+    return {series: tuple(group['order'].iloc[0]) for series, group in ranked.groupby('series')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--origins', type=int, default=8, help="forecast origins per series")
+    parser.add_argument('--horizon', type=int, default=5, help="days forecast from each origin")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--series', default=None, help="only series whose name contains this text")
+    parser.add_argument('--dry-run', action='store_true', help="report only, do not save the winning orders")
+    args = parser.parse_args()
+
+    import analytics_data
+    import sheets_client
+
+    df_1, df_2, df_3 = analytics_data.load_sheets(sheets_client.get_revision())
+    daily, _ = analytics_data.process_data(df_1, df_2, df_3)
+
+    started = time.perf_counter()
+    report = run_backtest(daily, n_origins=args.origins, horizon=args.horizon,
+                          workers=args.workers, series_filter=args.series)
+    print(report.sort_values(['series', 'mae']).to_string(index=False))
+    print(f"\n{len(report)} evaluations in {time.perf_counter() - started:.1f} s")
+
+    winners = best_orders(report)
+    for series, order in winners.items():
+        print(f"{series}: {order}")
+    if not args.dry_run:
+        orders = forecasting.load_orders()
+        orders.update(winners)
+        forecasting.save_orders(orders)
+        print(f"Saved to {forecasting.ORDERS_PATH}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Startup benchmark of the dashboard.
+
+Every measurement runs in a fresh interpreter, so nothing is already
+imported or cached:
+- import time of the heavy dependencies and of the app's own modules;
+- time of the first render of the login page, the Analytics page and the
+  data-entry page (streamlit.testing AppTest), and which heavy packages
+  each of them loaded.
+
+The background services of the app are switched off, so each page is
+measured alone. The authenticated pages use the secrets of
+.streamlit/secrets.toml if it exists; without them they render their error
+state, which is reported.
+
+Usage:
+    python bench_startup.py [--repeat 3] [--pages login analytics data-entry] [--skip-imports]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).parent
+
+# Modules whose import time is reported
+MODULES = [
+    'streamlit',
+    'streamlit_authenticator',
+    'pandas',
+    'pyarrow',
+    'gspread',
+    'google.oauth2.service_account',
+    'plotly.express',
+    'statsmodels.tsa.arima.model',
+    'sheets_client',
+    'analytics_data',
+    'main_app',
+    'charts',
+    'precompute',
+    'forecasting',
+]
+
+# Packages the login page should not need
+HEAVY_PACKAGES = ['pandas', 'pyarrow', 'gspread', 'google.oauth2', 'plotly', 'statsmodels', 'matplotlib']
+
+PAGES = ['login', 'analytics', 'data-entry']
+
+
+def _data_entry_page():
+    from main_app import app
+    app()
+
+
+def _measure_import(module):
+    started = time.perf_counter()
+    __import__(module)
+    return {'seconds': time.perf_counter() - started}
+
+
+def _measure_render(page):
+    from streamlit.testing.v1 import AppTest
+
+    if page == 'data-entry':
+        at = AppTest.from_function(_data_entry_page, default_timeout=600)
+    else:
+        at = AppTest.from_file(str(APP_DIR / "streamlit_app.py"), default_timeout=600)
+    if page != 'login':
+        secrets_path = APP_DIR / ".streamlit" / "secrets.toml"
+        if secrets_path.exists():
+            import tomllib
+            with secrets_path.open("rb") as file:
+                for key, value in tomllib.load(file).items():
+                    at.secrets[key] = value
+        # Skip the login form, as for a user with a valid session cookie
+        at.session_state['authentication_status'] = True
+        at.session_state['name'] = 'NDFZ'
+        at.session_state['username'] = 'ndfz'
+        at.session_state['logout'] = False
+
+    # AppTest itself may import some of them already; only the page's own imports are reported
+    already_loaded = set(sys.modules)
+    started = time.perf_counter()
+    at.run()
+    seconds = time.perf_counter() - started
+    return {
+        'seconds': seconds,
+        'loaded': [
+            package for package in HEAVY_PACKAGES
+            if package in sys.modules and package not in already_loaded
+        ],
+        'errors': len(at.exception) + len(at.error),
+    }
+
+
+def _run_child(kind, target):
+    """Measure one import or page render in a fresh interpreter."""
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', kind, target],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+        # Measure the page alone, without the warm-up thread importing the analytics stack
+        env=dict(os.environ, NDFZ_BACKGROUND_SERVICES="0"),
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help="fresh interpreters per measurement (median is reported)")
+    parser.add_argument('--pages', nargs='+', choices=PAGES, default=PAGES, help="pages to render")
+    parser.add_argument('--skip-imports', action='store_true', help="only measure the page renders")
+    parser.add_argument('--child', nargs=2, metavar=('KIND', 'TARGET'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, str(APP_DIR))
+        kind, target = args.child
+        result = _measure_import(target) if kind == 'import' else _measure_render(target)
+        print(json.dumps(result))
+        return
+
+    if not args.skip_imports:
+        print(f"{'import':<32}{'median, s':>10}{'min, s':>10}")
+        for module in MODULES:
+            times = [_run_child('import', module)['seconds'] for _ in range(args.repeat)]
+            print(f"{module:<32}{statistics.median(times):>10.3f}{min(times):>10.3f}")
+        print()
+
+    print(f"{'first render':<32}{'median, s':>10}{'min, s':>10}  errors  heavy packages loaded")
+    for page in args.pages:
+        results = [_run_child('render', page) for _ in range(args.repeat)]
+        times = [result['seconds'] for result in results]
+        last = results[-1]
+        print(f"{page:<32}{statistics.median(times):>10.3f}{min(times):>10.3f}  {last['errors']:>6}  "
+              f"{', '.join(last['loaded']) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Declarative chart specs for the Analytics page.
+
+A ChartSpec says what a chart shows (kind, title, series labels and colors)
+and which layout preset it uses; render() turns a spec and its data into a
+Plotly figure. Specs are frozen and hashable, so the serialized figure can be
+cached on spec, data revision and date window (see figure_json).
+
+Chart data is in long format: one row per day and series, with the columns
+'day', 'Показатель' (legend label) and 'value'.
+"""
+from dataclasses import dataclass
+
+import plotly.express as px
+
+# Horizontal legend centered above the plot area
+_LEGEND = dict(orientation="h", y=1.0, x=0.5, xanchor="center", yanchor="bottom")
+
+# Shared layout of each chart style
+PRESETS = {
+    'bars': dict(
+        margin=dict(l=5, r=5, t=5, b=1),  # Compact margins
+        height=180,
+        font=dict(size=9),  # Smaller font for compactness
+        legend_title='',
+        title_font_size=14,
+        legend=_LEGEND,
+    ),
+    'temperature': dict(
+        margin=dict(l=5, r=5, t=20, b=10),
+        height=160,
+        font=dict(size=9),
+        legend_title='',
+        title_font_size=14,
+        legend=_LEGEND,
+    ),
+}
+
+
+@dataclass(frozen=True)
+class ChartSpec:
+    """Content and style of one chart."""
+    kind: str  # 'bar' (grouped bars with value labels) or 'line' (line with labelled points)
+    title: str
+    value_label: str  # Axis title of the values
+    hover_label: str  # Name of the value in the hover text
+    preset: str = 'bars'
+    colors: tuple = ()  # (legend label, color) pairs; Plotly's defaults otherwise
+    hover_unit: str = ''
+    x_label: str = 'День'
+    tick_format: str = '%d %b'  # Day and month (e.g. "03 Dec")
+    text_decimals: int = 1  # Line charts: decimals of the point labels
+    margin_top: int = None  # Overrides the preset's top margin
+
+
+def render(spec, data):
+    """Build the Plotly figure of a spec from its long-format data."""
+    options = dict(
+        x='day',
+        y='value',
+        title=spec.title,
+        labels={'day': spec.x_label, 'value': spec.value_label, 'Показатель': ''},
+        color_discrete_map=dict(spec.colors),
+    )
+    if spec.kind == 'bar' or data['Показатель'].nunique() > 1:
+        options['color'] = 'Показатель'
+
+    if spec.kind == 'bar':
+        fig = px.bar(data, barmode='group', text_auto=True, **options)
+        # Labels inside the bars, in white
+        fig.update_traces(textposition='inside', textfont=dict(size=10, color='white'))
+    elif spec.kind == 'line':
+        fig = px.line(data, text=data['value'].round(spec.text_decimals), **options)
+        fig.update_traces(mode='lines+markers+text', textposition='top center')
+        # Add padding around the values
+        fig.update_yaxes(automargin=True, range=[data['value'].min() - 2, data['value'].max() + 2])
+    else:
+        raise ValueError(f"Unknown chart kind: {spec.kind}")
+
+    fig.update_traces(
+        hovertemplate=f'<b>{spec.x_label}:</b> %{{x}}<br><b>{spec.hover_label}:</b> %{{y}}{spec.hover_unit}<br>'
+    )
+    layout = dict(PRESETS[spec.preset], xaxis=dict(tickformat=spec.tick_format))
+    if spec.margin_top is not None:
+        layout['margin'] = dict(layout['margin'], t=spec.margin_top)
+    fig.update_layout(**layout)
+    return fig
+
+
+def figure_json(spec, data):
+    """Serialized figure of a spec, e.g. to be cached and sent again without rebuilding it."""
+    return render(spec, data).to_json()
+
+
+def melt_series(frame, series):
+    """Long-format chart data of the ``series`` (column -> legend label) of a frame with a 'day' column."""
+    data = frame[['day', *series]].dropna().melt(id_vars='day', var_name='Показатель', value_name='value')
+    data['Показатель'] = data['Показатель'].map(series)
+    return data
@@ -0,0 +1,455 @@
+"""ARIMA forecasting engine for the Analytics module.
+
+Fitted model state is kept per series. When a series only gained new days
+since the last fit, the new observations are appended to the existing state
+with the fitted parameters kept (a few milliseconds) instead of refitting on
+the whole history. A full refit happens on a schedule, or when older values
+of the series changed. Full fits of several series run in parallel on a
+bounded process pool, and a fit that fails or times out falls back to the
+previous model of the series (or to the last observed value).
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import monotonic, sleep
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.arima.model import ARIMA
+
+DEFAULT_ORDER = (2, 1, 2)
+
+# Refit the parameters from scratch once the last full fit is this old
+REFIT_INTERVAL = timedelta(days=7)
+
+# Upper bound on the number of fitting processes
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Seconds between checks for fits that started or timed out while waiting for the pool
+POLL_INTERVAL = 0.5
+
+# Pools replaced in a row because a worker died before any fit finished, before the
+# remaining fits of a batch fall back; the n-th replacement waits POOL_BACKOFF * 2 ** (n - 1) s
+MAX_POOL_RESTARTS = 3
+POOL_BACKOFF = 1.0
+
+# Seconds a single full fit may take, counted from its start in a worker, before its fallback is used
+FIT_TIMEOUT = 60
+
+# Forecast models are trained on the history since this day
+TRAINING_START = pd.Timestamp('2024-07-01')
+
+# Prefixes of the pivoted Spravka columns in the daily table
+SERIES_PREFIXES = ('plan_', 'fact_')
+
+# Cities whose average temperature drives the weather-aware load models
+TEMPERATURE_CITIES = ['Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']
+
+# Balance temperature (°C) of the heating/cooling degree regressors
+BALANCE_TEMPERATURE = 18.0
+
+# Spravka types modelled with the temperature regressors
+WEATHER_TYPES = ('Потребление', 'Нагрузка')
+
+# Best ARIMA order per series, written by backtest.py
+ORDERS_PATH = Path(os.environ.get("NDFZ_FORECAST_ORDERS", Path(__file__).parent / "forecast_orders.json"))
+
+
+@dataclass
+class SeriesState:
+    """Fitted model of one series and the observations it has seen."""
+    results: object
+    order: tuple
+    exog: tuple
+    last_date: pd.Timestamp
+    n_obs: int
+    checksum: int
+    fitted_at: datetime
+    error: str = None  # Why the last full fit was not used, if it was not
+
+
+def _checksum(frame):
+    return hash(frame.to_numpy(dtype=float).tobytes())
+
+
+def _split(frame):
+    """Endogenous values and exogenous matrix (None without regressors) of a prepared series."""
+    exog = frame.drop(columns='y').to_numpy(dtype=float)
+    return frame['y'].to_numpy(dtype=float), (exog if exog.shape[1] else None)
+
+
+# Queue on which a worker process reports the fits it starts (set by _init_worker)
+_started = None
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def _fit(fit_id, values, exog, order):
+    """Full ARIMA(X) fit; runs in a worker process."""
+    _started.put(fit_id)
+    return ARIMA(values, exog=exog, order=order).fit()
+
+
+class _FitPool(ProcessPoolExecutor):
+    """Process pool whose workers report when they start a fit, so fits are timed from their start."""
+
+    def __init__(self):
+        # spawn: forking a multi-threaded server process is not safe
+        context = multiprocessing.get_context("spawn")
+        # SimpleQueue: put() writes to the pipe at once, before the fit can hang or crash
+        self.started = context.SimpleQueue()
+        super().__init__(max_workers=MAX_WORKERS, mp_context=context,
+                         initializer=_init_worker, initargs=(self.started,))
+
+    def started_fits(self):
+        """IDs of the fits started since the last call."""
+        fit_ids = []
+        while not self.started.empty():
+            fit_ids.append(self.started.get())
+        return fit_ids
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_fit_ids = itertools.count()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _FitPool()
+        return _pool
+
+
+def _reset_pool(pool):
+    """Replace a pool whose workers died or hang on a timed-out fit, stopping its processes."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    # A hung worker never picks up the shutdown request, so its process is terminated
+    # (the executor has no public handle on its processes before Python 3.14)
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout=5)
+    pool.started.close()
+
+
+def _submit(values, exog, order):
+    """Submit a full fit, replacing the pool once if it is broken or shut down; returns (pool, fit ID, future)."""
+    fit_id = next(_fit_ids)
+    pool = _get_pool()
+    try:
+        return pool, fit_id, pool.submit(_fit, fit_id, values, exog, order)
+    except (BrokenProcessPool, RuntimeError):
+        _reset_pool(pool)
+        pool = _get_pool()
+        return pool, fit_id, pool.submit(_fit, fit_id, values, exog, order)
+
+
+class ForecastEngine:
+    """Keeps fitted ARIMA state per series and extends it as new days arrive."""
+
+    def __init__(self, refit_interval=REFIT_INTERVAL, fit_timeout=FIT_TIMEOUT):
+        self.refit_interval = refit_interval
+        self.fit_timeout = fit_timeout
+        self._states = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _series_lock(self, name):
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _is_prefix(self, state, frame):
+        """Whether ``frame`` is the fitted series plus new days at the end."""
+        if len(frame) < state.n_obs or frame.index[state.n_obs - 1] != state.last_date:
+            return False
+        return _checksum(frame.iloc[:state.n_obs]) == state.checksum
+
+    def _can_extend(self, state, frame, order):
+        if state is None or state.results is None or state.order != order:
+            return False
+        if state.exog != tuple(frame.columns[1:]):
+            return False
+        if datetime.now() - state.fitted_at > self.refit_interval:
+            return False
+        return self._is_prefix(state, frame)
+
+    def _extend(self, state, frame):
+        new_rows = frame.iloc[state.n_obs:]
+        if len(new_rows):
+            values, exog = _split(new_rows)
+            state.results = state.results.append(values, exog=exog)
+        self._observe(state, frame)
+
+    @staticmethod
+    def _observe(state, frame):
+        state.last_date = frame.index[-1]
+        state.n_obs = len(frame)
+        state.checksum = _checksum(frame)
+
+    def _fallback(self, name, frame, error):
+        """Keep the previous model of a series whose full fit failed."""
+        state = self._states.get(name)
+        if (state is not None and state.results is not None and state.exog == tuple(frame.columns[1:])
+                and self._is_prefix(state, frame)):
+            try:
+                self._extend(state, frame)
+                state.error = error
+                return
+            except Exception:
+                pass
+        # No usable model: forecast the last observed value
+        state = SeriesState(None, None, tuple(frame.columns[1:]), None, 0, 0, datetime.now(), error=error)
+        self._observe(state, frame)
+        self._states[name] = state
+
+    def _store(self, name, frame, order, results):
+        # A fit that did not fully converge is kept, as statsmodels itself does (ConvergenceWarning)
+        state = SeriesState(results, order, tuple(frame.columns[1:]), None, 0, 0, datetime.now())
+        self._observe(state, frame)
+        self._states[name] = state
+
+    def _fit_all(self, fits, prepared):
+        """Fully fit the (name, order) pairs on the process pool.
+
+        Each fit may take ``fit_timeout`` seconds from the moment a worker
+        starts it; the time spent queued behind other fits or waiting for a
+        new worker process does not count. A fit that fails, times out or
+        whose worker died falls back (see _fallback). The pool is then
+        replaced with its processes stopped, and the other fits interrupted
+        by that are submitted again. A dead worker fails every fit of its
+        pool: the ones not started yet are submitted again, the ones running
+        at that time once more before falling back. Pools that keep dying
+        (e.g. workers killed while starting up) are replaced with a growing
+        delay, at most MAX_POOL_RESTARTS times in a row.
+        """
+        pending = {}  # fit ID -> (future, name, order)
+        for name, order in fits:
+            try:
+                pool, fit_id, future = _submit(*_split(prepared[name]), order)
+            except Exception as e:
+                self._fallback(name, prepared[name], f"fit failed: {e}")
+                continue
+            pending[fit_id] = (future, name, order)
+        started = {}  # fit ID -> monotonic time its start was seen
+        crashes = {}  # series name -> times its worker died while running it
+        restarts = 0  # pools replaced after a dead worker since a fit last finished
+
+        while pending:
+            done, _ = wait([future for future, _, _ in pending.values()], timeout=POLL_INTERVAL,
+                           return_when=FIRST_COMPLETED)
+            now = monotonic()
+            for fit_id in pool.started_fits():
+                started.setdefault(fit_id, now)
+
+            broken = []
+            for fit_id, (future, name, order) in list(pending.items()):
+                if future not in done:
+                    continue
+                del pending[fit_id]
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    if fit_id in started:
+                        crashes[name] = crashes.get(name, 0) + 1
+                    if crashes.get(name, 0) > 1:
+                        self._fallback(name, prepared[name], "fit failed: its worker process died")
+                    else:
+                        broken.append((future, name, order))
+                    continue
+                except Exception as e:
+                    self._fallback(name, prepared[name], f"fit failed: {e}")
+                    continue
+                restarts = 0
+                self._store(name, prepared[name], order, results)
+
+            expired = [fit_id for fit_id in pending if fit_id in started and now - started[fit_id] >= self.fit_timeout]
+            for fit_id in expired:
+                _, name, _ = pending.pop(fit_id)
+                self._fallback(name, prepared[name], f"fit timed out after {self.fit_timeout} s")
+            if not (broken or expired):
+                continue
+
+            _reset_pool(pool)
+            # The fits still pending were stopped with the pool
+            interrupted = broken + list(pending.values())
+            pending.clear()
+            if broken:
+                restarts += 1
+                if restarts > MAX_POOL_RESTARTS:
+                    for _, name, _ in interrupted:
+                        self._fallback(name, prepared[name], "fit failed: the worker processes keep dying")
+                    return
+                sleep(POOL_BACKOFF * 2 ** (restarts - 1))
+            for _, name, order in interrupted:
+                try:
+                    pool, fit_id, future = _submit(*_split(prepared[name]), order)
+                except Exception as e:
+                    self._fallback(name, prepared[name], f"fit failed: {e}")
+                    continue
+                pending[fit_id] = (future, name, order)
+
+    def forecast_many(self, series_by_name, steps=5, orders=None, exog=None, exog_series=None):
+        """Forecast several day-indexed series at once.
+
+        ``orders`` optionally maps a series name to its ARIMA order.
+        ``exog`` is an optional day-indexed design matrix of regressors,
+        covering the history and the forecast days, used for the series
+        named in ``exog_series`` (all of them if not given). Days without
+        regressor values are left out of the fit; missing future values
+        carry the last known ones forward.
+
+        Series that only gained new days are extended in-process; the ones
+        that need a full fit are fitted in parallel on the process pool.
+        Missing values are dropped. Returns a mapping of series name to a
+        Series of forecasts indexed by the forecast days; its
+        ``attrs['error']`` says why the last full fit was not used (None if
+        it was), e.g. when the forecast is the last observed value.
+        """
+        orders = orders or {}
+        prepared = {}
+        for name, series in series_by_name.items():
+            frame = series.rename('y').to_frame()
+            if exog is not None and (exog_series is None or name in exog_series):
+                frame = frame.join(exog, how='left')
+            prepared[name] = frame.dropna()
+        forecasts = {
+            name: pd.Series(dtype=float, name=name) for name, frame in prepared.items() if frame.empty
+        }
+        names = sorted(name for name in prepared if name not in forecasts)
+        # Locks are taken in sorted order so concurrent batches cannot deadlock
+        locks = [self._series_lock(name) for name in names]
+        for lock in locks:
+            lock.acquire()
+        try:
+            fits = []
+            for name in names:
+                frame = prepared[name]
+                order = tuple(orders.get(name, DEFAULT_ORDER))
+                state = self._states.get(name)
+                if self._can_extend(state, frame, order):
+                    try:
+                        self._extend(state, frame)
+                        continue
+                    except Exception:
+                        pass
+                fits.append((name, order))
+            self._fit_all(fits, prepared)
+
+            for name in names:
+                state = self._states[name]
+                frame = prepared[name]
+                days = pd.date_range(start=state.last_date + pd.Timedelta(days=1), periods=steps)
+                if state.results is None:
+                    values = np.repeat(frame['y'].iloc[-1], steps)
+                elif state.exog:
+                    future = exog[list(state.exog)].reindex(days).ffill().fillna(frame[list(state.exog)].iloc[-1])
+                    values = state.results.forecast(steps=steps, exog=future.to_numpy(dtype=float))
+                else:
+                    values = state.results.forecast(steps=steps)
+                forecasts[name] = pd.Series(values, index=days, name=name)
+                forecasts[name].attrs['error'] = state.error
+            return forecasts
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+# Process-wide engine shared by all sessions
+engine = ForecastEngine()
+
+
+def load_orders():
+    """ARIMA order per series chosen by the backtest; series not listed use DEFAULT_ORDER."""
+    if not ORDERS_PATH.exists():
+        return {}
+    with ORDERS_PATH.open(encoding="utf-8") as file:
+        return {name: tuple(order) for name, order in json.load(file).items()}
+
+
+def save_orders(orders):
+    """Write the ARIMA order per series for the live forecasts."""
+    with ORDERS_PATH.open("w", encoding="utf-8") as file:
+        json.dump({name: list(order) for name, order in sorted(orders.items())}, file, ensure_ascii=False, indent=2)
+
+
+def discover_series(daily):
+    """Names of the pivoted Spravka series (plan_/fact_ columns) in the daily table."""
+    return [column for column in daily.columns if column.startswith(SERIES_PREFIXES)]
+
+
+def split_series_name(name):
+    """Split 'fact_<object>_<type>' into its measure, object and type."""
+    measure, rest = name.split('_', 1)
+    object_name, type_name = rest.rsplit('_', 1)
+    return measure, object_name, type_name
+
+
+def temperature_design(daily, cities=TEMPERATURE_CITIES, balance=BALANCE_TEMPERATURE):
+    """Day-indexed heating/cooling degree regressors from the average city temperature.
+
+    Covers every day of the daily table, including the future days Pogoda
+    already has, so the same matrix serves the fits and the forecasts.
+    """
+    temperature = daily[[city for city in cities if city in daily.columns]].mean(axis=1)
+    return pd.DataFrame({
+        'heating': (balance - temperature).clip(lower=0),
+        'cooling': (temperature - balance).clip(lower=0),
+    }, index=daily.index)
+
+
+def forecast_table(daily, steps=5, start=TRAINING_START, orders=None, weather=True, engine=engine):
+    """Forecast every pivoted Spravka series of the daily table in one batch.
+
+    ``orders`` defaults to the orders saved by the backtest. With ``weather``
+    the consumption and load series (WEATHER_TYPES) get the temperature
+    regressors of temperature_design (ARIMAX). Returns a long-format table
+    with one row per series and forecast day: series, measure, object,
+    type, day, value and error (why the series' forecast does not come
+    from its last full fit, None if it does).
+    """
+    if orders is None:
+        orders = load_orders()
+    history = daily.loc[start:]
+    names = discover_series(daily)
+    exog = exog_series = None
+    if weather and any(city in daily.columns for city in TEMPERATURE_CITIES):
+        exog = temperature_design(daily.loc[start:])
+        exog_series = {name for name in names if split_series_name(name)[2].startswith(WEATHER_TYPES)}
+    forecasts = engine.forecast_many(
+        {name: history[name] for name in names},
+        steps=steps, orders=orders, exog=exog, exog_series=exog_series,
+    )
+
+    frames = []
+    for name in names:
+        measure, object_name, type_name = split_series_name(name)
+        forecast = forecasts[name]
+        frames.append(pd.DataFrame({
+            'series': name,
+            'measure': measure,
+            'object': object_name,
+            'type': type_name,
+            'day': forecast.index,
+            'value': forecast.to_numpy(),
+            'error': forecast.attrs.get('error'),
+        }))
+    if not frames:
+        return pd.DataFrame(columns=['series', 'measure', 'object', 'type', 'day', 'value', 'error'])
+    return pd.concat(frames, ignore_index=True)
@@ -1,91 +1,72 @@
 import streamlit as st
-import gspread
-from google.oauth2.service_account import Credentials
 import pandas as pd
 import streamlit_authenticator as stauth
 import pickle
 import json
+import sheets_client
+import snapshot_store
+import write_journal
+
+# Names of the journal operations in the messages
+OPERATION_NAMES = {'add': "добавление", 'edit': "изменение", 'delete': "удаление"}
+
+
+@st.cache_data(max_entries=2)
+def load_restrictions(revision, applied):
+    """Read the Restrictions worksheet; cached per spreadsheet revision and last applied journal entry."""
+    # Fetch data from your source (e.g., Google Sheets or database)
+    # Not from the local snapshot: right after a flush Drive may still report the old
+    # revision, and a snapshot saved at it would hide the flushed entries
+    data = sheets_client.get_worksheet("Restrictions").get_all_values()
+
+    # Use only the first 6 columns
+    data = [row[:6] for row in data]
+
+    # Create DataFrame with the first row as headers
+    if data:
+        return pd.DataFrame(data[1:], columns=data[0])
+    return pd.DataFrame(columns=write_journal.COLUMNS)
 
 
 def app():
     # Display Title and Description
     # st.title("Форма для НДФЗ")
 
-    # Define the scope
-    SCOPES = [
-        'https://www.googleapis.com/auth/spreadsheets',
-        'https://www.googleapis.com/auth/drive'
-    ]
-
-    # Load credentials from Streamlit secrets
-    try:
-        # Use the AttrDict directly without parsing
-        service_account_info = st.secrets["GOOGLE_CREDENTIALS_PATH"]
-        credentials = Credentials.from_service_account_info(service_account_info, scopes=SCOPES)
-        client = gspread.authorize(credentials)
-    except Exception as e:
-        st.error(f"Ошибка авторизации: {e}")
-        st.stop()
-
-    # Open your Google Sheet
-    SPREADSHEET_NAME = "НДФЗ-Ограничение"  # Replace with your spreadsheet name
-    try:
-        spreadsheet = client.open(SPREADSHEET_NAME)
-        worksheet = spreadsheet.worksheet("Restrictions")
-    except Exception as e:
-        st.error(f"Ошибка доступа к Google Sheet: {e}")
-        st.stop()
-
     # Function to fetch data from the sheet
     def fetch_data():
         try:
-            # Fetch data from your source (e.g., Google Sheets or database)
-            data = worksheet.get_all_values()
-            
-            # Use only the first 6 columns
-            data = [row[:6] for row in data]
-            
-            # Create DataFrame with the first row as headers
-            if data:
-                df = pd.DataFrame(data[1:], columns=data[0])
-            else:
-                df = pd.DataFrame(columns=["ID", "Дата", "Время начала", "Время конца", "Тип", "Объем, МВт"])
-            
-            return df
+            # Re-read the sheet only when the spreadsheet revision changed or journal entries were written
+            # (Drive may report the new revision with a delay)
+            return load_restrictions(sheets_client.get_revision(), write_journal.last_applied())
         except Exception as e:
+            # Fall back to the local snapshot, read-only, when Google Sheets is unavailable
+            snapshot = snapshot_store.load("Restrictions")
+            if snapshot is not None:
+                st.warning(f"Google Sheets недоступен, показаны сохранённые данные: {e}")
+                return snapshot[0]
             st.error(f"Ошибка чтения данных: {e}")
-            return pd.DataFrame(columns=["ID", "Дата", "Время начала", "Время конца", "Тип", "Объем, МВт"])
-
+            return pd.DataFrame(columns=write_journal.COLUMNS)
 
-    # Function to update data in the sheet
-    def update_sheet(dataframe):
 
-        # Ensure 'Дата' is in datetime format for sorting
-        if 'Дата' in dataframe.columns:
-            dataframe['Дата'] = pd.to_datetime(dataframe['Дата'], format='%d.%m.%Y', errors='coerce')
-
-        # Sort by 'Дата' and 'Время начала'
-        if 'Время начала' in dataframe.columns:
-            dataframe = dataframe.sort_values(by=['Дата', 'Время начала'], ascending=[True, True])
-
-        # Convert 'Дата' back to string format for Google Sheets
-        if 'Дата' in dataframe.columns:
-            dataframe['Дата'] = dataframe['Дата'].dt.strftime('%d.%m.%Y')
-
-        # Replace NaN values with empty strings to ensure JSON compliance
-        dataframe = dataframe.fillna("")
-
-        worksheet.clear()
-        worksheet.append_row(dataframe.columns.tolist())  # Add headers
-        worksheet.append_rows(dataframe.values.tolist())  # Add rows
+    # Changes are written to the local journal first and applied to the sheet by a
+    # background flusher, so submits return at once and survive a Google Sheets outage
+    def write_record(op, record_id, row=None):
+        try:
+            write_journal.enqueue(op, record_id, row)
+        except Exception as e:
+            st.error(f"Ошибка записи данных: {e}")
+            st.stop()
 
 
     # Fetch initial data
-    existing_data = fetch_data()
+    sheet_data = fetch_data()
 
     # Add auto-generated ID column if it doesn't exist
-    if 'ID' not in existing_data.columns:
-        existing_data.insert(0, 'ID', range(1, len(existing_data) + 1))
+    if 'ID' not in sheet_data.columns:
+        sheet_data.insert(0, 'ID', range(1, len(sheet_data) + 1))
+
+    # Show the changes still waiting in the journal on top of the sheet
+    existing_data = write_journal.apply_pending(sheet_data)
 
     st.subheader("Форма")
 
@@ -119,33 +100,50 @@ def app():
             else:
                 # Auto-generate ID for the new record
                 if not existing_data.empty:
-                    existing_data['ID'] = pd.to_numeric(existing_data['ID'], errors='coerce')  # Ensure IDs are numeric
-                    new_id = existing_data['ID'].max() + 1
+                    new_id = pd.to_numeric(existing_data['ID'], errors='coerce').max() + 1  # Ensure IDs are numeric
                 else:
                     new_id = 1
 
                 new_row = [
-                    new_id,
+                    int(new_id),
                     date.strftime("%d.%m.%Y"),
                     start_time,
                     end_time,
                     restriction_type,
                     volume,
                 ]
-                # Append new data to the DataFrame
-                new_df = pd.DataFrame([new_row], columns=existing_data.columns)
-                new_df = new_df.fillna("")  # Replace NaN values with empty strings
-                existing_data = pd.concat([existing_data, new_df], ignore_index=True)
-                existing_data = existing_data.fillna("")  # Ensure no NaN values before updating
-                
-                # Update the Google Sheet
-                update_sheet(existing_data)
-                existing_data = fetch_data()
+
+                # Insert the new row at its sorted position (written to the sheet in the background)
+                write_record('add', int(new_id), new_row)
+                existing_data = write_journal.apply_pending(sheet_data)
                 st.success("Запись успешно добавлена!")
 
     # Display the existing data with a refresh button
     st.subheader("Существующие записи")
-    st.dataframe(existing_data)
+    # Changes that could not be written to the sheet (see write_journal)
+    rejected = write_journal.rejected()
+    if rejected:
+        st.warning("Не записаны в Google Sheets:\n" + "\n".join(
+            f"- {OPERATION_NAMES[operation['op']]} записи ID {operation['record_id']}: {operation['last_error']}"
+            for operation in rejected
+        ))
+        if st.button("Скрыть отклонённые изменения"):
+            write_journal.dismiss_rejected()
+            st.rerun()
+    # Placeholder, so an edit or delete below can show its result at once
+    records_table = st.empty()
+
+    def show_records(data):
+        with records_table.container():
+            operations = write_journal.pending()
+            if operations:
+                message = f"Ожидают записи в Google Sheets: {len(operations)}"
+                if operations[0]['last_error']:
+                    message += f" (последняя ошибка: {operations[0]['last_error']})"
+                st.info(message)
+            st.dataframe(data)
+
+    show_records(existing_data)
 
 
     # Edit/Delete Section
@@ -191,24 +189,26 @@ def app():
                 update_button = st.form_submit_button("Обновить запись")
 
                 if update_button:
-                    # Update the record in the DataFrame
-                    existing_data.loc[existing_data['ID'] == selected_id, ['Дата', 'Время начала', 'Время конца', 'Тип', 'Объем, МВт']] = [
+                    edited_row = [
+                        selected_id,
                         edit_date.strftime("%d.%m.%Y"),
                         edit_start_time,
                         edit_end_time,
                         edit_restriction_type,
                         edit_volume,
                     ]
-                    # Update the Google Sheet
-                    update_sheet(existing_data)
+                    # Update only the selected record's row in the Google Sheet
+                    write_record('edit', selected_id, edited_row)
+                    existing_data = write_journal.apply_pending(sheet_data)
+                    show_records(existing_data)
                     st.success("Запись успешно обновлена!")
 
         elif action == "Удалить":
             if st.button("Удалить запись"):
-                # Remove the record from the DataFrame
-                existing_data = existing_data[existing_data['ID'] != selected_id]
-                # Update the Google Sheet
-                update_sheet(existing_data)
+                # Remove only the selected record's row from the Google Sheet
+                write_record('delete', selected_id)
+                existing_data = write_journal.apply_pending(sheet_data)
+                show_records(existing_data)
                 st.success("Запись успешно удалена!")
 
 
@@ -0,0 +1,184 @@
+"""Headless precompute worker for the Analytics module.
+
+Runs the same pipeline as the Analytics page (sheet sync, process_data and
+the forecasts of every Spravka series) outside of Streamlit and writes the
+daily table, the restriction events and the forecast table to the local
+snapshot store, tagged with the spreadsheet revision. The page reads these
+results when they match the current revision instead of computing them.
+
+Inside the Streamlit server the same pipeline can run on a background thread
+(start_background_refresh), so the results are already warm when the first
+user opens the Analytics page and are refreshed on an interval afterwards.
+
+Usage:
+    python precompute.py            # run once
+    python precompute.py --every 600  # run every 10 minutes
+"""
+import argparse
+import threading
+import time
+from datetime import datetime
+
+import analytics_data
+import sheets_client
+import single_flight
+import snapshot_store
+
+RESULT_NAMES = ('results-daily', 'results-events', 'results-forecasts')
+
+# Days forecast for every series (as shown on the Analytics page)
+FORECAST_STEPS = 5
+
+# Seconds between two refreshes of the in-process results
+REFRESH_INTERVAL = 300
+
+# AnalyticsDataset of the in-process results, replaced as a whole
+_current = None
+_refresh_lock = threading.Lock()
+_refresh_thread = None
+_wake = threading.Event()
+
+
+def save_results(dataset):
+    """Store the processed tables and forecasts of an AnalyticsDataset."""
+    snapshot_store.save('results-daily', dataset.daily.reset_index(), dataset.revision)
+    snapshot_store.save('results-events', dataset.events.reset_index(), dataset.revision)
+    # Written last: results only count as complete once the forecasts are there
+    snapshot_store.save('results-forecasts', dataset.forecasts, dataset.revision)
+
+
+def load_results(revision):
+    """Return the stored AnalyticsDataset if it was computed for ``revision``."""
+    try:
+        snapshots = [snapshot_store.load(name) for name in RESULT_NAMES]
+    except Exception:
+        return None
+    if any(snapshot is None or snapshot[1] != revision for snapshot in snapshots):
+        return None
+    (daily, _, _), (events, _, _), (forecasts, _, _) = snapshots
+    return analytics_data.AnalyticsDataset(revision, daily.set_index('day'), events.set_index('day'), forecasts)
+
+
+def results_revision():
+    """Revision of the stored results, or None if there are none."""
+    snapshot = snapshot_store.load('results-forecasts')
+    return snapshot[1] if snapshot is not None else None
+
+
+def compute(revision):
+    """Sync the sheets for ``revision`` and return its AnalyticsDataset.
+
+    Each step is coalesced with the same step of the Analytics page running
+    for the same revision in another session.
+    """
+    # statsmodels is only loaded when forecasts are actually computed
+    import forecasting
+
+    df_1, df_2, df_3 = single_flight.do(('load_sheets', revision), analytics_data.load_sheets, revision)
+    daily, events = single_flight.do(('process_data', revision), analytics_data.process_data, df_1, df_2, df_3)
+    forecasts = single_flight.do(
+        ('forecast_table', revision, FORECAST_STEPS), forecasting.forecast_table, daily, steps=FORECAST_STEPS
+    )
+    return analytics_data.AnalyticsDataset(revision, daily, events, forecasts)
+
+
+def run_once(force=False):
+    """Run the pipeline if the spreadsheet changed since the stored results; returns the revision."""
+    revision = sheets_client.get_revision(max_age=0)
+    if not force and results_revision() == revision:
+        return revision
+    save_results(compute(revision))
+    return revision
+
+
+def refresh(force=False):
+    """Bring the in-process results up to date with the spreadsheet; returns the revision.
+
+    Results stored by the worker for the same revision are reused. The new
+    results are swapped in at once, readers see either the old or the new set.
+    """
+    global _current
+    revision = sheets_client.get_revision(max_age=0)
+    current = _current
+    if not force and current is not None and current.revision == revision:
+        return revision
+    _current = load_results(revision) or compute(revision)
+    return revision
+
+
+def get_dataset(revision):
+    """AnalyticsDataset of ``revision``: the in-process results, the stored ones, or computed now.
+
+    The returned object is shared by every caller and must not be modified.
+    """
+    current = _current
+    if current is not None and current.revision == revision:
+        return current
+    return single_flight.do(('dataset', revision), lambda: load_results(revision) or compute(revision))
+
+
+def serve(revision):
+    """Results to show for ``revision`` without computing anything, or None.
+
+    Returns the in-process results when they are of ``revision``. When they
+    are of an older revision and the background refresh runs, they are
+    returned too (the caller can tell from their revision) and the refresh
+    is woken to compute the new ones, instead of making the page wait.
+    """
+    current = _current
+    if current is None:
+        return None
+    if current.revision != revision:
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            return None
+        _wake.set()
+    return current
+
+
+def start_background_refresh(interval=REFRESH_INTERVAL):
+    """Warm the in-process results now and refresh them every ``interval`` seconds (once per process).
+
+    serve() wakes the refresh early when a page sees a newer revision.
+    """
+    global _refresh_thread
+    with _refresh_lock:
+        if _refresh_thread is not None and _refresh_thread.is_alive():
+            return
+
+        def loop():
+            while True:
+                try:
+                    refresh()
+                except Exception:
+                    # Pages compute the results themselves until the next refresh succeeds
+                    pass
+                _wake.wait(timeout=interval)
+                _wake.clear()
+
+        _refresh_thread = threading.Thread(target=loop, name="analytics-refresh", daemon=True)
+        _refresh_thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--every', type=int, default=None, help="repeat every N seconds instead of running once")
+    parser.add_argument('--force', action='store_true', help="recompute even if the spreadsheet did not change")
+    args = parser.parse_args()
+
+    while True:
+        started = time.perf_counter()
+        try:
+            revision = run_once(force=args.force)
+            print(f"{datetime.now():%Y-%m-%d %H:%M:%S} revision {revision} ready "
+                  f"in {time.perf_counter() - started:.1f} s", flush=True)
+        except Exception as e:
+            if args.every is None:
+                raise
+            print(f"{datetime.now():%Y-%m-%d %H:%M:%S} precompute failed: {e}", flush=True)
+        if args.every is None:
+            break
+        time.sleep(max(args.every - (time.perf_counter() - started), 0))
+
+
+if __name__ == '__main__':
+    main()
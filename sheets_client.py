@@ -0,0 +1,385 @@
+"""Shared Google Sheets client used by both the Analytics and data-entry modules.
+
+The authorized client, the spreadsheet handle and the worksheet handles are
+created once per process and reused by every Streamlit session and rerun.
+Every API call goes through TimedHTTPClient, which keeps the process within
+the per-minute Sheets quotas (token buckets), retries throttled and failed
+calls with exponential backoff (writes only when throttled) and counts the
+calls per endpoint, per minute and per Streamlit rerun.
+"""
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
+from gspread.utils import absolute_range_name
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+from requests.exceptions import ConnectionError, Timeout
+
+import single_flight
+
+# Define the scope
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+SPREADSHEET_NAME = "НДФЗ-Ограничение"
+
+# Refresh the access token this long before it expires
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# How long a fetched spreadsheet revision is trusted before asking Drive again, in seconds
+REVISION_MAX_AGE = 30
+
+# Sheets API requests allowed per minute (per-user quota); Drive calls are only counted
+QUOTA_PER_MINUTE = {'read': 60, 'write': 60}
+
+# Retries of a throttled (429) or failed (5xx, connection error) call, with exponential backoff;
+# writes are only retried when throttled, see _retryable
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+
+# Only held to read and publish the shared state; API calls are made outside of it, so a
+# throttled or retried call does not block the other sessions
+_lock = threading.RLock()
+_credentials = None
+_client = None
+_spreadsheet = None
+_worksheets = {}
+_headers = {}
+_revision = {'value': None, 'checked': 0.0, 'generation': 0}
+_refresh_thread = None
+
+_stats_lock = threading.Lock()
+_stats = {}
+_recent = deque()  # (monotonic time, quota) of the calls of the last minute
+_rerun = threading.local()  # call counters of the Streamlit rerun running on this thread
+
+
+def _endpoint(method, url):
+    """Short label for an API call, e.g. 'GET values' or 'POST values:batchGet'."""
+    path = url.split('?', 1)[0]
+    if 'googleapis.com/drive' in path:
+        return f"{method.upper()} drive"
+    match = re.search(r'/spreadsheets/[^/:]+(.*)$', path)
+    tail = match.group(1) if match else ''
+    values = re.match(r'/values(?:/[^:]*)?(?::(\w+))?$', tail)
+    if values:
+        return f"{method.upper()} values" + (f":{values.group(1)}" if values.group(1) else '')
+    if tail.startswith(':'):
+        return f"{method.upper()} {tail[1:]}"
+    return f"{method.upper()} spreadsheet"
+
+
+def _quota(label):
+    """Quota an API call counts against: 'read', 'write' or 'drive'."""
+    if label.endswith(' drive'):
+        return 'drive'
+    if label.startswith('GET') or label.endswith('values:batchGet'):
+        return 'read'
+    return 'write'
+
+
+class TokenBucket:
+    """Allows ``rate`` calls per ``period`` seconds, with bursts of up to ``rate`` calls."""
+
+    def __init__(self, rate, period=60.0):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty; returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.fill_rate
+            time.sleep(delay)
+            waited += delay
+
+
+_buckets = {quota: TokenBucket(rate) for quota, rate in QUOTA_PER_MINUTE.items()}
+
+
+def _record(label, elapsed, failed=False, retries=0, throttled=0.0):
+    with _stats_lock:
+        entry = _stats.setdefault(label, {
+            'calls': 0, 'errors': 0, 'retries': 0, 'total_s': 0.0, 'max_s': 0.0, 'throttled_s': 0.0,
+        })
+        entry['calls'] += 1
+        entry['errors'] += int(failed)
+        entry['retries'] += retries
+        entry['total_s'] += elapsed
+        entry['max_s'] = max(entry['max_s'], elapsed)
+        entry['throttled_s'] += throttled
+
+
+def _count(label):
+    """Count an API request (every attempt) for the per-minute and per-rerun counters."""
+    quota = _quota(label)
+    with _stats_lock:
+        _recent.append((time.monotonic(), quota))
+    counts = getattr(_rerun, 'counts', None)
+    if counts is not None:
+        counts[label] = counts.get(label, 0) + 1
+
+
+def _retryable(label, error):
+    throttled = isinstance(error, APIError) and error.response.status_code == 429
+    if _quota(label) == 'write':
+        # A write that failed with a 5xx or a lost response may have been applied, and the
+        # batchUpdate requests are positional (row indices): only a throttled write is safe
+        # to send again. The write journal re-reads the sheet before replaying the others.
+        return throttled
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    return throttled or (isinstance(error, APIError) and error.response.status_code >= 500)
+
+
+class TimedHTTPClient(HTTPClient):
+    """gspread HTTP client that rate-limits, retries and records every API call."""
+
+    def request(self, method, endpoint, *args, **kwargs):
+        label = _endpoint(method, endpoint)
+        bucket = _buckets.get(_quota(label))
+        started = time.perf_counter()
+        throttled = 0.0
+        for attempt in range(MAX_RETRIES + 1):
+            if bucket is not None:
+                throttled += bucket.acquire()
+            _count(label)
+            try:
+                response = super().request(method, endpoint, *args, **kwargs)
+                break
+            except Exception as e:
+                if attempt == MAX_RETRIES or not _retryable(label, e):
+                    _record(label, time.perf_counter() - started, failed=True, retries=attempt, throttled=throttled)
+                    raise
+            # Exponential backoff with jitter, as recommended for the Google APIs
+            time.sleep(min(BACKOFF_BASE * (2 ** attempt + random.random()), BACKOFF_MAX))
+        _record(label, time.perf_counter() - started, retries=attempt, throttled=throttled)
+        return response
+
+
+def _service_account_info():
+    # Imported here so the module can be used outside of a Streamlit app
+    import streamlit as st
+    return st.secrets["GOOGLE_CREDENTIALS_PATH"]
+
+
+def _refresh_loop():
+    """Keep the access token fresh so no request has to wait for a token refresh."""
+    while True:
+        with _lock:
+            credentials = _credentials
+        expiry = credentials.expiry
+        if expiry is not None and expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=timezone.utc)
+        now = datetime.now(timezone.utc)
+        if expiry is None or expiry - now <= TOKEN_REFRESH_MARGIN:
+            started = time.perf_counter()
+            try:
+                credentials.refresh(Request())
+                _record("POST token", time.perf_counter() - started)
+            except Exception:
+                # The session refreshes on its own on the next request; retry later
+                _record("POST token", time.perf_counter() - started, failed=True)
+                time.sleep(30)
+            continue
+        time.sleep(max((expiry - now - TOKEN_REFRESH_MARGIN).total_seconds(), 1))
+
+
+def get_client():
+    """Return the process-wide authorized gspread client."""
+    global _credentials, _client, _refresh_thread
+    with _lock:
+        if _client is None:
+            _credentials = Credentials.from_service_account_info(_service_account_info(), scopes=SCOPES)
+            _client = gspread.authorize(_credentials, http_client=TimedHTTPClient)
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            _refresh_thread = threading.Thread(target=_refresh_loop, name="sheets-token-refresh", daemon=True)
+            _refresh_thread.start()
+        return _client
+
+
+def get_spreadsheet():
+    """Return the shared handle of the НДФЗ-Ограничение spreadsheet."""
+    global _spreadsheet
+    with _lock:
+        if _spreadsheet is not None:
+            return _spreadsheet
+    spreadsheet = get_client().open(SPREADSHEET_NAME)
+    with _lock:
+        if _spreadsheet is None:
+            _spreadsheet = spreadsheet
+        return _spreadsheet
+
+
+def get_worksheet(title):
+    """Return the shared handle of a worksheet, loading all handles in one metadata call."""
+    with _lock:
+        if title in _worksheets:
+            return _worksheets[title]
+    worksheets = get_spreadsheet().worksheets()
+    with _lock:
+        for worksheet in worksheets:
+            _worksheets.setdefault(worksheet.title, worksheet)
+        if title not in _worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return _worksheets[title]
+
+
+def _fetch_revision():
+    with _lock:
+        generation = _revision['generation']
+    response = get_client().http_client.request(
+        'get',
+        f"{DRIVE_FILES_API_V3_URL}/{get_spreadsheet().id}",
+        params={'fields': 'version,modifiedTime', 'supportsAllDrives': True},
+    )
+    metadata = response.json()
+    value = f"{metadata['version']}:{metadata['modifiedTime']}"
+    with _lock:
+        # Not published if invalidate_revision() ran meanwhile: the answer may predate that write
+        if _revision['generation'] == generation:
+            _revision['value'] = value
+            _revision['checked'] = time.monotonic()
+    return value
+
+
+def get_revision(max_age=REVISION_MAX_AGE):
+    """Cheap change marker of the spreadsheet, used like an HTTP ETag.
+
+    Asks Drive for the file's version and modifiedTime (a tiny metadata call)
+    at most once every ``max_age`` seconds. Any edit to any worksheet changes it.
+    """
+    with _lock:
+        if _revision['value'] is not None and time.monotonic() - _revision['checked'] <= max_age:
+            return _revision['value']
+    # Sessions asking at the same moment share one Drive call
+    return single_flight.do(('get_revision',), _fetch_revision)
+
+
+def invalidate_revision():
+    """Force the next get_revision() call to ask Drive, e.g. right after a write."""
+    with _lock:
+        _revision['value'] = None
+        _revision['generation'] += 1
+
+
+def _column_letter(index):
+    """Column letter for a 1-based column index (1 -> A, 27 -> AA)."""
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def _load_headers(titles):
+    """Fetch the header rows of several worksheets in one request and cache them."""
+    with _lock:
+        headers = {title: _headers[title] for title in titles if title in _headers}
+    missing = [title for title in titles if title not in headers]
+    if missing:
+        response = get_spreadsheet().values_batch_get(
+            [absolute_range_name(title, '1:1') for title in missing]
+        )
+        fetched = {
+            title: (value_range.get('values') or [[]])[0]
+            for title, value_range in zip(missing, response['valueRanges'])
+        }
+        with _lock:
+            _headers.update(fetched)
+        headers.update(fetched)
+    return headers
+
+
+def batch_get_columns(columns_by_sheet, first_rows=None):
+    """Fetch only the named columns of several worksheets in a single values.batchGet request.
+
+    ``columns_by_sheet`` maps a worksheet title to the header names to fetch.
+    ``first_rows`` optionally maps a worksheet title to the 1-based sheet row
+    to start reading from, so only rows below it are downloaded.
+    Returns a mapping of worksheet title to a list of rows, header row first,
+    like ``get_all_values`` but restricted to the requested columns.
+    """
+    first_rows = first_rows or {}
+    for attempt in range(2):
+        headers = _load_headers(list(columns_by_sheet))
+        try:
+            ranges = [
+                absolute_range_name(title, f"{letter}{first_rows.get(title, 1)}:{letter}")
+                for title, columns in columns_by_sheet.items()
+                for letter in (_column_letter(headers[title].index(column) + 1) for column in columns)
+            ]
+            break
+        except ValueError:
+            if attempt:
+                raise
+            # A header was renamed or moved since it was cached; reload the layout once
+            with _lock:
+                _headers.clear()
+
+    response = get_spreadsheet().values_batch_get(ranges, params={'majorDimension': 'COLUMNS'})
+    value_ranges = iter(response['valueRanges'])
+
+    result = {}
+    for title, columns in columns_by_sheet.items():
+        values = [((next(value_ranges).get('values') or [[]])[0]) for _ in columns]
+        height = max(len(column) for column in values)
+        # Trailing empty cells are omitted by the API, pad columns to the same length
+        values = [column + [''] * (height - len(column)) for column in values]
+        rows = [list(row) for row in zip(*values)]
+        if first_rows.get(title, 1) > 1:
+            rows.insert(0, list(columns))
+        result[title] = rows or [list(columns)]
+    return result
+
+
+def get_stats():
+    """Per-endpoint call counters and latencies, in seconds."""
+    with _stats_lock:
+        return {
+            label: dict(entry, avg_s=entry['total_s'] / entry['calls'] if entry['calls'] else 0.0)
+            for label, entry in _stats.items()
+        }
+
+
+def calls_last_minute():
+    """API requests of the last 60 seconds per quota ('read', 'write', 'drive'), retries included."""
+    cutoff = time.monotonic() - 60
+    with _stats_lock:
+        while _recent and _recent[0][0] < cutoff:
+            _recent.popleft()
+        counts = {quota: 0 for quota in (*QUOTA_PER_MINUTE, 'drive')}
+        for _, quota in _recent:
+            counts[quota] += 1
+        return counts
+
+
+def begin_rerun():
+    """Start counting the API requests made by the Streamlit rerun running on this thread."""
+    _rerun.counts = {}
+
+
+def rerun_calls():
+    """API requests per endpoint made so far by the current rerun on this thread."""
+    return dict(getattr(_rerun, 'counts', None) or {})
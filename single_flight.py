@@ -0,0 +1,78 @@
+"""Single-flight coalescing of identical concurrent calls.
+
+When several sessions ask for the same result at the same moment (e.g. the
+sheets of a new revision right after it appeared), only the first caller
+runs the function; the others wait for it and share its result or its
+exception. Nothing is cached once the call finished, that is left to the
+callers' caches.
+"""
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time and counts the coalesced calls."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """Return ``function(*args, **kwargs)``, joining a call with the same key already in flight.
+
+        ``key`` is a tuple whose first item names the operation in the stats,
+        e.g. ``('load_sheets', revision)``.
+        """
+        with self._lock:
+            entry = self._stats.setdefault(key[0], {'calls': 0, 'computed': 0, 'coalesced': 0})
+            entry['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                entry['computed'] += 1
+            else:
+                entry['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Calls, computed calls and coalesced calls per operation."""
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._stats.items()}
+
+
+# Process-wide group shared by all sessions and background threads
+group = SingleFlight()
+
+
+def do(key, function, *args, **kwargs):
+    """Run ``function`` through the process-wide group (see SingleFlight.do)."""
+    return group.do(key, function, *args, **kwargs)
+
+
+def stats():
+    """Coalescing counters of the process-wide group."""
+    return group.stats()
@@ -0,0 +1,52 @@
+"""Local on-disk snapshots of the Google Sheets worksheets.
+
+Each worksheet is stored as an Arrow IPC file and read back through a memory
+map, so a restarted process can start from the local copy instead of
+downloading the whole history again, and the dashboard can still be shown
+read-only when the Sheets API is unavailable or throttled.
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pyarrow as pa
+
+SNAPSHOT_DIR = Path(os.environ.get("NDFZ_SNAPSHOT_DIR", Path(__file__).parent / ".snapshots"))
+
+
+def _path(name):
+    return SNAPSHOT_DIR / f"{name}.arrow"
+
+
+def save(name, dataframe, revision):
+    """Atomically write a DataFrame snapshot tagged with the spreadsheet revision."""
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'revision': str(revision).encode(),
+        b'saved_at': str(time.time()).encode(),
+    })
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, _path(name))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(name):
+    """Return ``(dataframe, revision, saved_at)`` of a snapshot, or None if there is none."""
+    path = _path(name)
+    if not path.exists():
+        return None
+    with pa.memory_map(str(path), "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        dataframe = table.to_pandas()
+    metadata = table.schema.metadata or {}
+    revision = metadata.get(b'revision', b'').decode() or None
+    saved_at = float(metadata.get(b'saved_at', b'0').decode())
+    return dataframe, revision, saved_at
@@ -1,21 +1,29 @@
+import json
 import pickle
+import threading
 from pathlib import Path
 import streamlit as st
 import streamlit_authenticator as stauth
 from streamlit_option_menu import option_menu
 import sys
 import os
-from main_app import app
-import pandas as pd
-from google.oauth2.service_account import Credentials
-import gspread
-import matplotlib.pyplot as plt
-import plotly.express as px
+from dataclasses import replace
 from datetime import datetime, timedelta
-from statsmodels.tsa.arima.model import ARIMA
+
+# Heavy modules (pandas, gspread, plotly, statsmodels) are imported where they are first
+# needed, so the login page does not wait for them (see bench_startup.py)
 
 # st.set_page_config(layout="wide")
 
+# How many data revisions to keep cached (the current one and the previous one)
+CACHED_REVISIONS = 2
+
+# Point count above which scatter charts are drawn with WebGL
+WEBGL_MIN_POINTS = 500
+
+# Users who see the Google Sheets API budget in the sidebar
+ADMIN_USERS = ['ndfz']
+
 hide_streamlit_style = """
             <style>
             MainMenu {visibility: hidden;}
@@ -41,6 +49,24 @@ hide_streamlit_style = """
             """
 st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 
+# Once per process: warm the analytics results while the login page is shown and keep them
+# fresh, and apply data-entry changes left in the write journal (e.g. by a previous run during
+# an outage). The modules are imported on the background thread.
+@st.cache_resource
+def start_background_services():
+    def start():
+        import precompute
+        import write_journal
+        precompute.start_background_refresh()
+        write_journal.start_flusher()
+
+    threading.Thread(target=start, name="background-services", daemon=True).start()
+
+
+# Can be switched off, e.g. when precompute.py runs as a separate worker or for benchmarks
+if os.environ.get("NDFZ_BACKGROUND_SERVICES", "1") != "0":
+    start_background_services()
+
 # Add the parser_module directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'parser_module')))
 
@@ -87,6 +113,11 @@ if 'authentication_status' not in st.session_state:
 name, authentication_status, username = authenticator.login("Login", "main")
 
 if authentication_status:
+    import sheets_client
+
+    # Count the Google Sheets API calls made by this rerun
+    sheets_client.begin_rerun()
+
     with st.sidebar:
         # Determine available modules based on user
         if username == 'ndfz':
@@ -110,354 +141,164 @@ if authentication_status:
     st.session_state.authentication_status = True
 
     if app_menu == "Загрузка данных":
+        from main_app import app
         app()
 
     if app_menu == "Аналитика":
-        
-
-        # Define the scope
-        SCOPES = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-
-        @st.cache_data
-        def load_google_sheets_data():
-            """Fetch data from Google Sheets and return as DataFrames."""
+        # The analytics stack is only imported when the page is opened
+        import numpy as np
+        import pandas as pd
+        import plotly.express as px
+        import plotly.graph_objects as go
+        import analytics_data
+        import charts
+        import precompute
+
+        # The processed data is cached per spreadsheet revision with st.cache_resource: one
+        # read-only object per process shared by every session, instead of a copy per caller.
+        @st.cache_resource(max_entries=CACHED_REVISIONS)
+        def load_dataset(revision):
+            """Daily facts, restriction events and forecasts of a revision."""
             try:
-                # Load credentials from Streamlit secrets
-                service_account_info = st.secrets["GOOGLE_CREDENTIALS_PATH"]
-                client = gspread.service_account_from_dict(service_account_info)
-                
-                # Open Google Sheets
-                spreadsheet = client.open("НДФЗ-Ограничение")
-                restrictions = spreadsheet.worksheet("Restrictions")
-                spravka = spreadsheet.worksheet("Spravka")
-                pogoda = spreadsheet.worksheet("Pogoda")
-
-                # Fetch data
-                data_1 = restrictions.get_all_values()
-                data_2 = spravka.get_all_values()
-                data_3 = pogoda.get_all_values()
-
-                # Convert to DataFrames
-                df_1 = pd.DataFrame(data_1[1:], columns=data_1[0])
-                df_2 = pd.DataFrame(data_2[1:], columns=data_2[0])
-                df_3 = pd.DataFrame(data_3[1:], columns=data_3[0])
-                
-                return df_1, df_2, df_3
-
+                # Results warmed in the background or stored by precompute.py are reused;
+                # otherwise only rows appended since the last refresh are downloaded
+                return precompute.get_dataset(revision)
             except Exception as e:
                 st.error(f"Ошибка загрузки данных: {e}")
                 st.stop()
 
-        @st.cache_data
-        def process_data(df_1, df_2, df_3):
-            """Process data and merge into a combined DataFrame."""
-            # Convert dates
-            df_1['Дата'] = pd.to_datetime(df_1['Дата'], format='%d.%m.%Y')
-            df_2['day'] = pd.to_datetime(df_2['day'])
-            df_3['day'] = pd.to_datetime(df_3['day'])
-
-            # Pivot df_2
-            df_2_pivot = df_2.pivot_table(
-                index='day',
-                columns=['object', 'type'],
-                values=['plan', 'fact'],
-                aggfunc='sum'
-            ).reset_index()
-            df_2_pivot.columns = ['_'.join(col).strip() if col[1] else col[0] for col in df_2_pivot.columns]
-
-            # Pivot df_3
-            df_3_pivot = df_3.pivot_table(
-                index='day',
-                columns='city',
-                values='temperature_2m',
-                aggfunc='sum'
-            ).reset_index()
-
-            # Select specific columns from df_1
-            columns_to_select = ['Дата', 'Время начала', 'Время конца', 'Тип', 'Объем, МВт']
-            df_1_selected = df_1[columns_to_select]
-
-            # Merge data
-            combined_df = df_3_pivot.merge(df_2_pivot, on='day', how='outer')\
-                                    .merge(df_1_selected, left_on='day', right_on='Дата', how='outer')
-
-            # Drop unnecessary columns and rows
-            combined_df.drop(columns=['Дата'], inplace=True)
-            combined_df.dropna(subset=['day'], inplace=True)
-
-            return combined_df
-
         # Load and process data
-        df_1, df_2, df_3 = load_google_sheets_data()
-        combined_df = process_data(df_1, df_2, df_3)
-
-        # Ensure 'day' column only shows the date
-        combined_df['day'] = pd.to_datetime(combined_df['day']).dt.date
-
-        # Convert all other columns to numeric
-        columns_to_exclude = ['day', 'Время начала', 'Время конца', 'Тип']
-        columns_to_convert = combined_df.columns.difference(columns_to_exclude)
-        combined_df[columns_to_convert] = combined_df[columns_to_convert].apply(pd.to_numeric, errors='coerce')
-
-
-        # Get the latest month in the data
-        combined_df['day'] = pd.to_datetime(combined_df['day'], errors='coerce')
+        try:
+            revision = sheets_client.get_revision()
+        except Exception as e:
+            revision = None
+            sheets_error = e
+
+        local_revision = analytics_data.local_revision()
+        if revision is None:
+            # Google Sheets is unavailable: show the local snapshot read-only
+            if local_revision is None:
+                st.error(f"Ошибка загрузки данных: {sheets_error}")
+                st.stop()
+            revision = local_revision
+            st.warning(f"Google Sheets недоступен, показаны сохранённые данные: {sheets_error}")
+        elif local_revision is not None and revision != local_revision and not analytics_data.is_synced():
+            # Fresh process: serve the local snapshot now and sync with the sheet in the background
+            analytics_data.reconcile_in_background(revision)
+            revision = local_revision
+            saved_at = datetime.fromtimestamp(analytics_data.snapshot_time()).strftime('%d.%m.%Y %H:%M')
+            st.info(f"Показаны сохранённые данные от {saved_at}, идёт синхронизация с Google Sheets.")
+        # While the background refresh computes a new revision, the previous results are shown
+        dataset = precompute.serve(revision) or load_dataset(revision)
+        if dataset.revision != revision:
+            st.caption("Показаны данные предыдущей версии таблицы, идёт обновление.")
+
+        st.subheader("Аналитика")
 
         # Set default start and end dates
         end_day_default = datetime.today().date()  # Today's date
         start_day_default = (datetime.today() - timedelta(days=7)).date()  # 10 days before today
 
-        # User input for filters in separate columns
-        col1, col2, col3 = st.columns(3)
-
-        with col1:
-            st.subheader("Аналитика")
-        with col2:
-            start_day = st.date_input("Выберите начальную дату", value=start_day_default)
-        with col3:
-            end_day = st.date_input("Выберите конечную дату", value=end_day_default)
-
-        col1, col2 = st.columns(2)
-        with col1:
+        # Series shown on the charts (column -> legend label)
+        SOUTH_SERIES = {
+            'fact_Южный Казахстан_Генерация(МВт)': 'Генерация Юж. Казахстан (МВт)',
+            'fact_Южный Казахстан_Потребление(МВт)': 'Потребление Юж. Казахстан (МВт)',
+        }
+        ZHGRES_SERIES = {
+            'fact_АО "Жамбылская ГРЭС"_Нагрузка': 'Факт ЖГРЭС (МВт)',
+            'plan_АО "Жамбылская ГРЭС"_Нагрузка': 'План ЖГРЭС (МВт)',
+        }
+        ZHGRES_FORECAST_SERIES = {
+            'fact_АО "Жамбылская ГРЭС"_Нагрузка': 'Факт Жамбылская ГРЭС (МВт)',
+            'plan_АО "Жамбылская ГРЭС"_Нагрузка': 'План Жамбылская ГРЭС (МВт)',
+        }
+
+        # Chart specs of the historical and forecast panels
+        south_chart = charts.ChartSpec(
+            'bar', 'Юж. Казахстан, МВт', 'МВт', 'МВт',
+            colors=(('Генерация Юж. Казахстан (МВт)', '#1f77b4'), ('Потребление Юж. Казахстан (МВт)', '#ff7f0e')),
+        )
+        zhgres_chart = charts.ChartSpec('bar', 'Нагрузка ЖГРЭС, МВт', 'МВт', 'МВт')
+        temperature_chart = charts.ChartSpec(
+            'line', 'Температура Юж. Казахстана, (°C)', 'Т (°C)', 'Средняя температура',
+            preset='temperature', hover_unit=' °C',
+        )
+        south_forecast_chart = replace(south_chart, title='Прогноз, МВт')
+        zhgres_forecast_chart = replace(zhgres_chart, title='Прогноз ЖГРЭС, МВт')
+        temperature_forecast_chart = replace(temperature_chart, title='Температура, °C', margin_top=25)
+
+        # Serialized figures are cached on the chart spec, the data revision and the date window,
+        # so unchanged charts are not rebuilt by Plotly Express on every interaction.
+        # The chart data is only prepared on a cache miss.
+        @st.cache_data(max_entries=64)
+        def cached_figure(spec, revision, window, _chart_data):
+            return charts.figure_json(spec, _chart_data())
+
+        def show_chart(spec, revision, window, chart_data):
+            st.plotly_chart(json.loads(cached_figure(spec, revision, window, chart_data)), use_container_width=True)
+
+        # Panel title followed by a custom minimal space divider
+        def panel_title(title):
             st.markdown(
-                "<div style='text-align: center; font-size: 16px; font-weight: bold;'>Факт данные</div>",
+                f"<div style='text-align: center; font-size: 16px; font-weight: bold;'>{title}</div>",
                 unsafe_allow_html=True
             )
-
-        with col2:
             st.markdown(
-                "<div style='text-align: center; font-size: 16px; font-weight: bold;'>Прогнозные данные</div>",
+                "<hr style='border: 1px solid #ccc; margin: 5px 0;'>",
                 unsafe_allow_html=True
             )
 
-        # Add a divider between the blocks
-        # Custom minimal space divider
-        st.markdown(
-            "<hr style='border: 1px solid #ccc; margin: 5px 0;'>",
-            unsafe_allow_html=True
-        )
-
-        # Convert 'start_day' and 'end_day' back to datetime for comparison
-        start_day = pd.to_datetime(start_day)
-        end_day = pd.to_datetime(end_day)
-
-        # Filter the data based on the selected dates
-        filtered_data = combined_df[(combined_df['day'] >= start_day) & (combined_df['day'] <= end_day)]
-
-        # Ensure filtered data is not empty
-        if filtered_data.empty:
-            st.warning("Нет данных для выбранного диапазона дат.")
-        else:
-            # First Chart: Генерация и Потребление по Южному Казахстану
-            chart_data_1 = (
-                filtered_data[['day', 'fact_Южный Казахстан_Генерация(МВт)', 'fact_Южный Казахстан_Потребление(МВт)']]
-                .dropna()
-                .drop_duplicates(subset=['day'])
-            )
-
-            # Melt the data to reshape for Plotly
-            chart_data_1 = chart_data_1.melt(id_vars='day', var_name='Показатель', value_name='МВт')
-
-            # Rename legend labels by mapping values
-            chart_data_1['Показатель'] = chart_data_1['Показатель'].replace({
-                'fact_Южный Казахстан_Генерация(МВт)': 'Генерация Юж. Казахстан (МВт)',
-                'fact_Южный Казахстан_Потребление(МВт)': 'Потребление Юж. Казахстан (МВт)'
-            })
-
-            # Define custom colors for the categories in the legend
-            color_map = {
-                'Генерация Юж. Казахстан (МВт)': '#1f77b4',  # Blue
-                'Потребление Юж. Казахстан (МВт)': '#ff7f0e'  # Orange
-            }
-
-            # Create the first chart
-            fig1 = px.bar(
-                chart_data_1,
-                x='day',
-                y='МВт',
-                color='Показатель',
-                title='Юж. Казахстан, МВт',
-                labels={'day': 'День', 'МВт': 'МВт'},
-                barmode='group',
-                height=270,
-                color_discrete_map=color_map,  # Apply custom colors
-                text_auto=True  # Automatically display data labels
-            )
-
-            fig1.update_traces(hovertemplate='<b>День:</b> %{x}<br><b>МВт:</b> %{y}<br>')
-
-            # Adjust text position and color inside columns
-            fig1.update_traces(
-                textposition='inside',  # Position labels inside bars
-                textfont=dict(size=10, color='white')  # Set text color to white
-            )
-
-            fig1.update_layout(
-                xaxis=dict(
-                    tickformat='%d %b',  # Show day and month only (e.g., "03 Dec")
-                ),
-                margin=dict(l=5, r=5, t=5, b=1),  # Compact margins
-                height=180,  # Reduced height
-                font=dict(size=9),  # Smaller font for compactness
-                legend_title='',
-                title_font_size=14,
-                legend=dict(
-                    orientation="h",
-                    y=1.0,
-                    x=0.5,
-                    xanchor="center",
-                    yanchor="bottom"
-                ),
-            )
-
-
-            # Second Chart: Нагрузка по Жамбылской ГРЭС
-            chart_data_2 = (
-                filtered_data[['day', 'fact_АО "Жамбылская ГРЭС"_Нагрузка', 'plan_АО "Жамбылская ГРЭС"_Нагрузка']]
-                .dropna()
-                .drop_duplicates(subset=['day'])
-            )
-
-            # Melt the data to reshape for Plotly
-            chart_data_2 = chart_data_2.melt(id_vars='day', var_name='Показатель', value_name='МВт')
-
-            # Rename legend labels by mapping values
-            chart_data_2['Показатель'] = chart_data_2['Показатель'].replace({
-                'fact_АО "Жамбылская ГРЭС"_Нагрузка': 'Факт ЖГРЭС (МВт)',
-                'plan_АО "Жамбылская ГРЭС"_Нагрузка': 'План ЖГРЭС (МВт)'
-            })
-
-            # Create the second chart
-            fig2 = px.bar(
-                chart_data_2,
-                x='day',
-                y='МВт',
-                color='Показатель',
-                title='Нагрузка ЖГРЭС, МВт',
-                labels={'day': 'День', 'МВт': 'МВт'},
-                barmode='group',
-                height=270,
-                text_auto=True  # Automatically display data labels
-            )
-
-            fig2.update_traces(hovertemplate='<b>День:</b> %{x}<br><b>МВт:</b> %{y}<br>')
-
-            # Adjust text position and color inside columns
-            fig2.update_traces(
-                textposition='inside',  # Position labels inside bars
-                textfont=dict(size=10, color='white')  # Set text color to white
-            )
-
-            fig2.update_layout(
-                xaxis=dict(
-                    tickformat='%d %b',  # Show day and month only (e.g., "03 Dec")
-                ),
-                margin=dict(l=5, r=5, t=5, b=1),
-                height=180,
-                font=dict(size=9),
-                legend_title='',
-                title_font_size=14,
-                legend=dict(
-                    orientation="h",
-                    y=1.0,
-                    x=0.5,
-                    xanchor="center",
-                    yanchor="bottom"
-                ),
-            )
-
-            # Filter relevant columns for the weather data
-            weather_data = filtered_data[['day', 'Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']].dropna()
-
-            # Calculate the average temperature across the cities
-            weather_data['Средняя температура'] = weather_data[['Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']].mean(axis=1)
-
-            # Create a Plotly line chart
-            fig3 = px.line(
-                weather_data,
-                x='day',
-                y='Средняя температура',
-                title='Температура Юж. Казахстана, (°C)',
-                labels={'day': 'День', 'Средняя температура': 'Т (°C)'},
-                height=100
-            )
-
-            # Add data labels to the chart
-            fig3.update_traces(
-                mode='lines+markers+text',  # Add lines, markers, and text labels
-                text=weather_data['Средняя температура'].round(1),  # Display rounded temperature values as text
-                textposition='top center'  # Position of the text labels
-            )
-
-            # Customize the layout for better appearance
-            fig3.update_layout(
-                xaxis=dict(
-                    tickformat='%d %b',  # Show day and month only (e.g., "03 Dec")
-                ),
-                yaxis=dict(
-                    automargin=True,  # Ensure enough space for Y-axis
-                    range=[
-                        weather_data['Средняя температура'].min() - 2,  # Add padding to minimum value
-                        weather_data['Средняя температура'].max() + 2   # Add padding to maximum value
-                    ]
-                ),
-                margin=dict(l=5, r=5, t=20, b=10),
-                height=160,
-                font=dict(size=9),
-                title_font_size=14,
-            )
-
-            # Filter relevant columns for the chart
-            activation_data = filtered_data[['day', 'Время начала', 'Время конца', 'Тип', 'Объем, МВт']]
-        
+        # The panels are fragments: changing the dates only reruns the historical column
+        # (and the restriction history inside it), the forecast panel does not depend on them.
+        @st.fragment
+        def restriction_history(filtered_events):
             # Define custom colors based on 'Тип'
             color_map = {
                 'САОН': 'blue',  # Replace 'Тип 1' with actual type values from your data
                 'Команда СО': 'red'    # Replace 'Тип 2' with actual type values from your data
             }
 
-            # Create a custom hover template
-            activation_data['hover_text'] = (
-                'Дата: ' + activation_data['day'].astype(str) + '<br>' +
-                'c ' + activation_data['Время начала'] +
-                ' до ' + activation_data['Время конца'] +
-                ', объем: ' + activation_data['Объем, МВт'].astype(str) + ' МВт'
+            # Hover text built column-wise as a separate Series (the shared events are not modified)
+            hover_text = (
+                'Дата: ' + filtered_events['day'].dt.strftime('%Y-%m-%d') +
+                '<br>c ' + analytics_data.format_minutes(filtered_events['Время начала']) +
+                ' до ' + analytics_data.format_minutes(filtered_events['Время конца']) +
+                ', объем: ' + filtered_events['Объем, МВт'].astype(str) + ' МВт'
             )
-            # Create a scatter plot
+
+            # Create a scatter plot (WebGL for long ranges)
             fig = px.scatter(
-                activation_data,
+                filtered_events,
                 x='day',
                 y='Объем, МВт',
                 color='Тип',
                 title='История ограничений НДФЗ',
                 labels={'day': 'День', 'Объем, МВт': 'МВт'},
                 color_discrete_map=color_map,  # Apply custom colors
+                custom_data=[hover_text],  # Split per trace together with the points
+                render_mode='webgl' if len(filtered_events) > WEBGL_MIN_POINTS else 'svg',
             )
 
             # Customize hover data
             fig.update_traces(
                 mode='markers',  # Use points only
                 marker=dict(size=10),  # Adjust point size
-                hovertemplate='%{customdata}<extra></extra>',
-                customdata=activation_data['hover_text']  # Attach custom hover text
+                hovertemplate='%{customdata[0]}<extra></extra>',
             )
 
-
-            # Add vertical lines for each unique date
-            for unique_date in activation_data['day'].unique():
-                fig.add_shape(
-                    type="line",
-                    x0=unique_date,
-                    x1=unique_date,
-                    y0=0,
-                    y1=activation_data['Объем, МВт'].max() * 1.1,  # Extend the line slightly above the max value
-                    line=dict(color="gray", width=1, dash="dot"),  # Style for vertical lines
-                    xref="x",
-                    yref="y"
-                )
+            # Vertical lines for every activation date, drawn as one trace with gaps between the lines
+            days = filtered_events['day'].drop_duplicates()
+            fig.add_trace(go.Scatter(
+                x=np.repeat(days.to_numpy(), 3),
+                y=np.tile([0, filtered_events['Объем, МВт'].max() * 1.1, np.nan], len(days)),  # Slightly above the max value
+                mode='lines',
+                line=dict(color="gray", width=1, dash="dot"),  # Style for vertical lines
+                connectgaps=False,
+                hoverinfo='skip',
+                showlegend=False,
+            ))
+            # Keep the lines behind the points
+            fig.data = fig.data[-1:] + fig.data[:-1]
 
             # Customize x-axis to show only activation dates
             fig.update_layout(
@@ -482,230 +323,123 @@ if authentication_status:
                 ),
             )
 
-            #################################
-
-            # Cache forecast for Generation and Consumption
-            @st.cache_data
-            def compute_generation_forecast(df, steps=5):
-                model_gen = ARIMA(df['fact_Южный Казахстан_Генерация(МВт)'], order=(2, 1, 2))
-                model_fit_gen = model_gen.fit()
-                forecast_gen = model_fit_gen.forecast(steps=steps)
-                return [round(value) for value in forecast_gen]
-
-            @st.cache_data
-            def compute_consumption_forecast(df, steps=5):
-                model_cons = ARIMA(df['fact_Южный Казахстан_Потребление(МВт)'], order=(2, 1, 2))
-                model_fit_cons = model_cons.fit()
-                forecast_cons = model_fit_cons.forecast(steps=steps)
-                return [round(value) for value in forecast_cons]
-
-            # Cache forecast for Жамбылская ГРЭС
-            @st.cache_data
-            def compute_grs_forecasts(df, steps=5):
-                model_fact = ARIMA(df['fact_АО "Жамбылская ГРЭС"_Нагрузка'], order=(2, 1, 2))
-                model_fit_fact = model_fact.fit()
-                forecast_fact = model_fit_fact.forecast(steps=steps)
-
-                model_plan = ARIMA(df['plan_АО "Жамбылская ГРЭС"_Нагрузка'], order=(2, 1, 2))
-                model_fit_plan = model_plan.fit()
-                forecast_plan = model_fit_plan.forecast(steps=steps)
-
-                return [round(value) for value in forecast_fact], [round(value) for value in forecast_plan]
-
-            # Cache weather forecast
-            @st.cache_data
-            def compute_average_temperature_forecast(df, forecast_days):
-                weather_forecast_data = df[df['day'].isin(forecast_days)][['day', 'Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']]
-                weather_forecast_data['Средняя температура'] = weather_forecast_data[['Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']].mean(axis=1)
-                return weather_forecast_data
-
-
-
-            # Filter the input data
-            df_pred_1 = combined_df[combined_df['day'] >= pd.Timestamp('2024-07-01')][
-                ['day', 'fact_Южный Казахстан_Генерация(МВт)', 'fact_Южный Казахстан_Потребление(МВт)']
-            ].dropna().drop_duplicates(subset=['day'])
-
-            forecast_days = pd.date_range(start=df_pred_1['day'].max() + pd.Timedelta(days=1), periods=5)
-
-            # Get cached forecasts
-            forecast_1 = compute_generation_forecast(df_pred_1)
-            forecast_2 = compute_consumption_forecast(df_pred_1)
-
-            forecast_data = pd.DataFrame({
-                'day': list(forecast_days) * 2,  # Duplicate forecast_days to match the length of Показатель and МВт
-                'Показатель': ['Генерация Юж. Казахстан (МВт)'] * 5 + ['Потребление Юж. Казахстан (МВт)'] * 5,
-                'МВт': list(forecast_1) + list(forecast_2)
-            })
-
-            # Define custom colors for the categories in the legend
-            color_map = {
-                'Генерация Юж. Казахстан (МВт)': '#1f77b4',  # Blue
-                'Потребление Юж. Казахстан (МВт)': '#ff7f0e'  # Orange
-            }
-            # Create the second chart (Forecasts)
-            fig1b = px.bar(
-                forecast_data,
-                x='day',
-                y='МВт',
-                color='Показатель',
-                title='Прогноз, МВт',
-                labels={'day': 'День', 'МВт': 'МВт'},
-                barmode='group',
-                height=270,
-                color_discrete_map=color_map,  # Apply custom colors
-                text_auto=True  # Automatically display data labels
-            )
-
-            fig1b.update_traces(hovertemplate='<b>День:</b> %{x}<br><b>МВт:</b> %{y}<br>')
-
-            # Adjust text position and color inside columns
-            fig1b.update_traces(
-                textposition='inside',  # Position labels inside bars
-                textfont=dict(size=10, color='white')  # Set text color to white
-            )
-
-            fig1b.update_layout(
-                xaxis=dict(
-                    tickformat='%d %b',  # Show day and month only (e.g., "03 Dec")
-                ),
-                margin=dict(l=5, r=5, t=5, b=1),  # Compact margins
-                height=180,  # Reduced height
-                font=dict(size=9),  # Smaller font for compactness
-                legend_title='',
-                title_font_size=14,
-                legend=dict(
-                    orientation="h",
-                    y=1.0,
-                    x=0.5,
-                    xanchor="center",
-                    yanchor="bottom"
-                ),
-            )
-
-            # Prepare data for Жамбылская ГРЭС
-            df_pred_2 = combined_df[combined_df['day'] >= pd.Timestamp('2024-07-01')][
-                ['day', 'fact_АО "Жамбылская ГРЭС"_Нагрузка', 'plan_АО "Жамбылская ГРЭС"_Нагрузка']
-            ].dropna().drop_duplicates(subset=['day'])
-
-            forecast_fact, forecast_plan = compute_grs_forecasts(df_pred_2)
-
-            # Prepare forecast data for visualization
-            forecast_days_2 = pd.date_range(start=df_pred_2['day'].max() + pd.Timedelta(days=1), periods=5)
+            st.plotly_chart(fig, use_container_width=True)
 
-            forecast_data_2 = pd.DataFrame({
-                'day': list(forecast_days_2) * 2,
-                'Показатель': ['Факт Жамбылская ГРЭС (МВт)'] * 5 + ['План Жамбылская ГРЭС (МВт)'] * 5,
-                'МВт': forecast_fact + forecast_plan
-            })
+        @st.fragment
+        def historical_panel(dataset):
+            panel_title("Факт данные")
 
-            # Create the second chart for Жамбылская ГРЭС forecasts
-            fig2b = px.bar(
-                forecast_data_2,
-                x='day',
-                y='МВт',
-                color='Показатель',
-                title='Прогноз ЖГРЭС, МВт',
-                labels={'day': 'День', 'МВт': 'МВт'},
-                barmode='group',
-                height=270,
-                text_auto=True
-            )
-
-            fig2b.update_traces(hovertemplate='<b>День:</b> %{x}<br><b>МВт:</b> %{y}<br>')
-
-            fig2b.update_traces(
-                textposition='inside',
-                textfont=dict(size=10, color='white')
-            )
-
-            fig2b.update_layout(
-                xaxis=dict(
-                    tickformat='%d %b'
-                ),
-                margin=dict(l=5, r=5, t=5, b=1),
-                height=180,
-                font=dict(size=9),
-                legend_title='',
-                title_font_size=14,
-                legend=dict(
-                    orientation="h",
-                    y=1.0,
-                    x=0.5,
-                    xanchor="center",
-                    yanchor="bottom"
-                )
-            )
-
-
-            # Filter combined_df for weather predictions in the forecast range
-            weather_forecast_data = combined_df[
-                combined_df['day'].isin(forecast_days)
-            ][['day', 'Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']]
-
-            # Calculate the average temperature for each day
-            weather_forecast_data['Средняя температура'] = weather_forecast_data[['Кызылорда', 'Тараз', 'Шымкент', 'Туркестан']].mean(axis=1)
-
-            # Create a line chart for average temperature predictions
-            fig3b = px.line(
-                weather_forecast_data,
-                x='day',
-                y='Средняя температура',
-                title='Температура, °C',
-                labels={'day': 'День', 'Средняя температура': 'Т (°C)'},
-                markers=True,  # Add markers for points
-                height=270
-            )
-
-            # Customize hover information
-            fig3b.update_traces(
-                hovertemplate='<b>День:</b> %{x}<br><b>Средняя температура:</b> %{y} °C<br>'
-            )
-
-            # Add data labels to the chart
-            fig3b.update_traces(
-                mode='lines+markers+text',  # Add lines, markers, and text labels
-                text=weather_forecast_data['Средняя температура'].round(1),  # Display rounded temperature values as text
-                textposition='top center'  # Position of the text labels
-            )
-
-            # Customize layout
-            fig3b.update_layout(
-                xaxis=dict(
-                    tickformat='%d %b'  # Show day and month only
-                ),
-                yaxis=dict(
-                            automargin=True,  # Ensure enough space for Y-axis
-                            range=[
-                                weather_forecast_data['Средняя температура'].min() - 2,  # Add padding to minimum value
-                                weather_forecast_data['Средняя температура'].max() + 2   # Add padding to maximum value
-                            ]
-                        ),
-                margin=dict(l=5, r=5, t=25, b=10),
-                height=160,  # Adjust height
-                font=dict(size=9),  # Compact font
-                title_font_size=14,
-                legend=dict(
-                    orientation="h",
-                    y=1.0,
-                    x=0.5,
-                    xanchor="center",
-                    yanchor="bottom"
-                )
-            )
-
-
-            # Display fig2 and fig2b in two columns
+            # User input for filters in separate columns
             col1, col2 = st.columns(2)
             with col1:
-                st.plotly_chart(fig1, use_container_width=True)
-                st.plotly_chart(fig2, use_container_width=True)  # Historical chart for Жамбылская ГРЭС
-                st.plotly_chart(fig3, use_container_width=True)  # Historical chart for Жамбылская ГРЭС
-                st.plotly_chart(fig, use_container_width=True) # Historical chart for Жамбылская ГРЭС
+                start_day = st.date_input("Выберите начальную дату", value=start_day_default)
             with col2:
-                st.plotly_chart(fig1b, use_container_width=True)
-                st.plotly_chart(fig2b, use_container_width=True)  # Forecast chart for Жамбылская ГРЭС
-                st.plotly_chart(fig3b, use_container_width=True)  # Forecast chart for Жамбылская ГРЭС
+                end_day = st.date_input("Выберите конечную дату", value=end_day_default)
+
+            # Convert 'start_day' and 'end_day' back to datetime for comparison
+            start_day = pd.to_datetime(start_day)
+            end_day = pd.to_datetime(end_day)
+
+            # Filter the data based on the selected dates
+            # Slices of the shared data are lazy copies, the base frames are never copied or modified
+            daily_data, filtered_events = dataset.window(start_day, end_day)
+            filtered_events = filtered_events.reset_index()
+
+            # Bar charts get weekly or monthly means once the window has more days than the point budget
+            filtered_data, resolution = dataset.chart_window(start_day, end_day)
+            filtered_data = filtered_data.reset_index()
+            period_label = {'D': 'День', 'W': 'Неделя с', 'M': 'Месяц'}[resolution]
+            tick_format = '%b %Y' if resolution == 'M' else '%d %b'
+            if resolution != 'D':
+                st.caption("Средние значения по " + ("неделям" if resolution == 'W' else "месяцам"))
+                numeric_columns = filtered_data.columns.drop('day')
+                filtered_data[numeric_columns] = filtered_data[numeric_columns].round()
+
+            # Ensure filtered data is not empty
+            if filtered_data.empty:
+                st.warning("Нет данных для выбранного диапазона дат.")
+                return
+
+            # Average temperature across the cities; long windows keep the points that preserve
+            # the shape of the line (LTTB)
+            def temperature_data():
+                # Only needed on a cache miss, so statsmodels is not loaded by a cached render
+                from forecasting import TEMPERATURE_CITIES
+                average = daily_data[TEMPERATURE_CITIES].dropna().mean(axis=1)
+                kept = analytics_data.lttb(average.index.to_numpy(dtype='datetime64[D]').astype('int64'), average)
+                return pd.DataFrame({'day': average.index[kept], 'Показатель': 'Средняя температура', 'value': average.iloc[kept].to_numpy()})
+
+            window = (start_day, end_day)
+            axis = dict(x_label=period_label, tick_format=tick_format)
+            show_chart(replace(south_chart, **axis), dataset.revision, window,
+                       lambda: charts.melt_series(filtered_data, SOUTH_SERIES))
+            show_chart(replace(zhgres_chart, **axis), dataset.revision, window,
+                       lambda: charts.melt_series(filtered_data, ZHGRES_SERIES))
+            show_chart(replace(temperature_chart, tick_format=tick_format), dataset.revision, window, temperature_data)
+            restriction_history(filtered_events)
+
+        @st.fragment
+        def forecast_panel(dataset):
+            panel_title("Прогнозные данные")
+
+            # Forecasts of every Spravka series, computed in one batch (long format)
+            forecast_table = dataset.forecasts
+
+            # Select forecasts of the given series from the table, labelled for the legend
+            def select_forecasts(series):
+                selected = pd.concat([forecast_table[forecast_table['series'] == name] for name in series])
+                return pd.DataFrame({
+                    'day': selected['day'],
+                    'Показатель': selected['series'].map(series),
+                    'value': selected['value'].round(),
+                })
+
+            # Average temperature of the South forecast days Pogoda already has
+            def temperature_forecast_data():
+                from forecasting import TEMPERATURE_CITIES
+                forecast_days = pd.DatetimeIndex(
+                    forecast_table.loc[forecast_table['series'].isin(SOUTH_SERIES), 'day'].unique()
+                )
+                average = dataset.daily.reindex(forecast_days)[TEMPERATURE_CITIES].dropna(how='all').mean(axis=1)
+                return pd.DataFrame({'day': average.index, 'Показатель': 'Средняя температура', 'value': average.to_numpy()})
+
+            # The forecasts only change with the revision, so the window part of the cache key is empty
+            show_chart(south_forecast_chart, dataset.revision, None, lambda: select_forecasts(SOUTH_SERIES))
+            show_chart(zhgres_forecast_chart, dataset.revision, None, lambda: select_forecasts(ZHGRES_FORECAST_SERIES))
+            show_chart(temperature_forecast_chart, dataset.revision, None, temperature_forecast_data)
+
+            # Series shown with a fallback forecast (previous model or last observed value)
+            if 'error' in forecast_table:
+                labels = {**SOUTH_SERIES, **ZHGRES_FORECAST_SERIES}
+                shown = forecast_table[forecast_table['series'].isin(labels)].dropna(subset='error')
+                for name, error in shown.drop_duplicates('series')[['series', 'error']].itertuples(index=False):
+                    st.caption(f"{labels[name]}: прогноз без новой модели ({error})")
+
+        # Display the historical and forecast panels in two columns
+        col1, col2 = st.columns(2)
+        with col1:
+            historical_panel(dataset)
+        with col2:
+            forecast_panel(dataset)
+
+    # Google Sheets API budget: requests of the last minute against the quota, of this rerun and per endpoint
+    if username in ADMIN_USERS:
+        import pandas as pd
+        import single_flight
+
+        with st.sidebar.expander("API Google Sheets"):
+            last_minute = sheets_client.calls_last_minute()
+            st.dataframe(pd.DataFrame({
+                'Запросов за минуту': last_minute,
+                'Квота в минуту': sheets_client.QUOTA_PER_MINUTE,
+            }), use_container_width=True)
+            rerun_calls = sheets_client.rerun_calls()
+            st.caption(f"Запросов за это обновление страницы: {sum(rerun_calls.values())}")
+            if rerun_calls:
+                st.dataframe(pd.Series(rerun_calls, name='Запросов'), use_container_width=True)
+            st.dataframe(pd.DataFrame(sheets_client.get_stats()).T.round(3), use_container_width=True)
+            st.caption("Объединённые одновременные вычисления")
+            st.dataframe(pd.DataFrame(single_flight.stats()).T, use_container_width=True)
 
 
 
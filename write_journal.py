@@ -0,0 +1,382 @@
+"""Local write-behind journal for the data-entry module.
+
+Submitted changes to the Restrictions worksheet are first appended to a
+SQLite journal on disk, so the form returns at once and no entry is lost
+when Google Sheets is slow or unavailable. A background flusher applies the
+pending operations to the sheet in order, all of them in a single
+spreadsheets.batchUpdate request, and retries after failures (also after a
+restart of the app). Until then the page shows the sheet with the pending
+operations applied on top (apply_pending).
+
+Operations address records by ID, so replaying an operation that already
+reached the sheet (e.g. after a crash before it was marked applied) does not
+duplicate the record. An 'add' never overwrites a record: if its ID was
+taken meanwhile by another one (IDs are chosen from the page's view, which is
+the local snapshot during an outage), the record gets the next free ID. An
+'edit' of a record that no longer exists is rejected instead of recreating
+it, and an operation that Google Sheets keeps refusing (MAX_ATTEMPTS) is
+set aside; rejected operations are kept in the journal and shown on the
+page, the others flush past them.
+"""
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+from gspread.exceptions import APIError
+
+import analytics_data
+import sheets_client
+
+JOURNAL_PATH = Path(os.environ.get("NDFZ_WRITE_JOURNAL", Path(__file__).parent / ".journal.sqlite3"))
+
+WORKSHEET = "Restrictions"
+
+# Columns written by the data-entry form
+COLUMNS = analytics_data.SHEET_COLUMNS[WORKSHEET]
+
+# Seconds between flush attempts while operations are pending (a submit flushes at once)
+FLUSH_INTERVAL = 30
+
+# Failed flushes after which an operation that Google Sheets refuses as invalid is set aside
+MAX_ATTEMPTS = 5
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = None
+
+
+def _connect():
+    JOURNAL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(JOURNAL_PATH, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS operations ("
+        " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " op TEXT NOT NULL,"
+        " record_id TEXT NOT NULL,"
+        " row TEXT,"
+        " created_at REAL NOT NULL,"
+        " applied_at REAL,"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " last_error TEXT,"
+        " rejected_at REAL,"
+        " dismissed INTEGER NOT NULL DEFAULT 0)"
+    )
+    # Journals created before operations could be rejected
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(operations)")}
+    for column, definition in (('rejected_at', 'REAL'), ('dismissed', 'INTEGER NOT NULL DEFAULT 0')):
+        if column not in columns:
+            connection.execute(f"ALTER TABLE operations ADD COLUMN {column} {definition}")
+    return connection
+
+
+@contextmanager
+def _journal():
+    """Serialized connection to the journal; commits on success and is closed afterwards."""
+    with _lock:
+        connection = _connect()
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+def enqueue(op, record_id, row=None):
+    """Durably record an 'add', 'edit' or 'delete' of a record and wake the flusher; returns its sequence number."""
+    if op not in ('add', 'edit', 'delete'):
+        raise ValueError(f"Unknown operation: {op}")
+    with _journal() as connection:
+        cursor = connection.execute(
+            "INSERT INTO operations (op, record_id, row, created_at) VALUES (?, ?, ?, ?)",
+            (op, str(record_id), json.dumps(row, ensure_ascii=False) if row is not None else None, time.time()),
+        )
+        seq = cursor.lastrowid
+    start_flusher()
+    _wake.set()
+    return seq
+
+
+def _operations(where):
+    with _journal() as connection:
+        rows = connection.execute(
+            "SELECT seq, op, record_id, row, attempts, last_error FROM operations"
+            f" WHERE {where} ORDER BY seq"
+        ).fetchall()
+    return [
+        {'seq': seq, 'op': op, 'record_id': record_id, 'row': json.loads(row) if row else None,
+         'attempts': attempts, 'last_error': last_error}
+        for seq, op, record_id, row, attempts, last_error in rows
+    ]
+
+
+def pending():
+    """Operations not yet applied to the sheet (nor rejected), oldest first."""
+    return _operations("applied_at IS NULL AND rejected_at IS NULL")
+
+
+def rejected():
+    """Rejected operations not dismissed yet, oldest first; 'last_error' says why."""
+    return _operations("rejected_at IS NOT NULL AND dismissed = 0")
+
+
+def dismiss_rejected():
+    """Stop showing the rejected operations (they stay in the journal)."""
+    with _journal() as connection:
+        connection.execute("UPDATE operations SET dismissed = 1 WHERE rejected_at IS NOT NULL")
+
+
+def last_applied():
+    """Sequence number of the last operation applied to the sheet (0 if none)."""
+    with _journal() as connection:
+        return connection.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM operations WHERE applied_at IS NOT NULL"
+        ).fetchone()[0]
+
+
+def _sort_key(date_str, start_time):
+    """Sheet order: by 'Дата' (dd.mm.yyyy) then 'Время начала'; unparseable dates go last."""
+    date = pd.to_datetime(date_str, format='%d.%m.%Y', errors='coerce')
+    if pd.isna(date):
+        date = pd.Timestamp.max
+    return (date, str(start_time))
+
+
+def _cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+class Rejected(Exception):
+    """An operation that cannot be applied to the current sheet."""
+
+
+def _normalized(row):
+    """Cells of a row as compared between the journal and the sheet (5.0 and '5' are equal)."""
+    cells = []
+    for value in row:
+        try:
+            cells.append(float(value))
+        except (TypeError, ValueError):
+            cells.append(str(value).strip())
+    return cells
+
+
+def _id_number(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _apply(rows, operation, sheet_id=None):
+    """Apply an operation to ``rows`` (sheet data rows, in sheet order) in place.
+
+    Returns the record ID the operation was applied as (an 'add' whose ID is
+    taken gets the next free one) and the batchUpdate requests that make the
+    same change on the sheet, given that it currently holds ``rows`` below
+    its header. Raises Rejected for an 'edit' of a missing record.
+    """
+    record_id = operation['record_id']
+    index = next((i for i, row in enumerate(rows) if row and str(row[0]) == record_id), None)
+
+    def dimension(i):
+        # Data row i (0-based) is sheet row i + 2, i.e. grid index i + 1
+        return {'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': i + 1, 'endIndex': i + 2}
+
+    if operation['op'] == 'delete':
+        if index is None:
+            # Already deleted
+            return record_id, []
+        del rows[index]
+        return record_id, [{'deleteDimension': {'range': dimension(index)}}]
+
+    new_row = list(operation['row'])
+    if operation['op'] == 'add' and index is not None:
+        if _normalized(rows[index]) == _normalized(new_row):
+            # Replayed after it reached the sheet (e.g. a crash before it was marked applied)
+            return record_id, []
+        # The ID was taken meanwhile: use the next free one instead of overwriting that record
+        record_id = str(max(_id_number(row[0]) for row in rows if row) + 1)
+        new_row[0] = int(record_id)
+        index = None
+    elif operation['op'] == 'edit' and index is None:
+        raise Rejected(f"запись ID {record_id} не найдена в таблице")
+
+    # Written at the record's sorted position
+    others = [row for i, row in enumerate(rows) if i != index]
+    keys = [_sort_key(row[1], row[2]) for row in others]
+    target = bisect.bisect_right(keys, _sort_key(new_row[1], new_row[2]))
+    values = {'updateCells': {
+        'start': {'sheetId': sheet_id, 'rowIndex': target + 1, 'columnIndex': 0},
+        'rows': [{'values': [_cell(value) for value in new_row]}],
+        'fields': 'userEnteredValue',
+    }}
+    requests = []
+    if index is not None and index != target:
+        requests.append({'deleteDimension': {'range': dimension(index)}})
+    if index is None or index != target:
+        requests.append({'insertDimension': {'range': dimension(target), 'inheritFromBefore': False}})
+    requests.append(values)
+    others.insert(target, [str(value) for value in new_row])
+    rows[:] = others
+    return record_id, requests
+
+
+def _replay(rows, operations, sheet_id=None, renamed=None):
+    """Apply operations to ``rows`` in order; returns their batchUpdate requests and outcomes.
+
+    The outcome of an operation (by seq) is the record ID it was applied as,
+    or the Rejected error. Edits and deletes of an added record whose ID
+    changed follow it to its new ID (``renamed``, updated in place).
+    """
+    renamed = {} if renamed is None else renamed
+    requests, outcomes = [], {}
+    for operation in operations:
+        original_id = operation['record_id']
+        if operation['op'] != 'add' and original_id in renamed:
+            record_id = renamed[original_id]
+            row = [int(record_id), *operation['row'][1:]] if operation['row'] else None
+            operation = dict(operation, record_id=record_id, row=row)
+        try:
+            record_id, operation_requests = _apply(rows, operation, sheet_id)
+        except Rejected as e:
+            outcomes[operation['seq']] = e
+            continue
+        if operation['op'] == 'add':
+            if record_id != original_id:
+                renamed[original_id] = record_id
+            else:
+                renamed.pop(original_id, None)
+        requests.extend(operation_requests)
+        outcomes[operation['seq']] = record_id
+    return requests, outcomes
+
+
+def apply_pending(records):
+    """Optimistic view: the Restrictions DataFrame with the pending operations applied."""
+    operations = pending()
+    if not operations:
+        return records
+    rows = records[COLUMNS].astype(str).values.tolist()
+    _replay(rows, operations)
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def flush():
+    """Apply all pending operations to the sheet in one batchUpdate request; returns how many."""
+    with _flush_lock:
+        return _flush()
+
+
+def _invalid(error):
+    """Whether Google Sheets refused the request itself, as opposed to an outage, throttling or auth failure."""
+    return isinstance(error, APIError) and error.response.status_code == 400
+
+
+def _record_failure(operations, error):
+    with _journal() as connection:
+        connection.executemany(
+            "UPDATE operations SET attempts = attempts + 1, last_error = ? WHERE seq = ?",
+            [(str(error), operation['seq']) for operation in operations],
+        )
+
+
+def _reject(operation, reason):
+    with _journal() as connection:
+        connection.execute(
+            "UPDATE operations SET rejected_at = ?, last_error = ? WHERE seq = ?",
+            (time.time(), reason, operation['seq']),
+        )
+
+
+def _send(worksheet, rows, operations, renamed):
+    """Apply operations to the sheet in one batchUpdate and record their outcome.
+
+    ``rows`` and ``renamed`` are only updated once the request succeeded.
+    """
+    new_rows = [list(row) for row in rows]
+    new_renamed = dict(renamed)
+    requests, outcomes = _replay(new_rows, operations, worksheet.id, new_renamed)
+    if requests:
+        worksheet.spreadsheet.batch_update({'requests': requests})
+        sheets_client.invalidate_revision()
+    rows[:] = new_rows
+    renamed.clear()
+    renamed.update(new_renamed)
+
+    now = time.time()
+    with _journal() as connection:
+        for operation in operations:
+            outcome = outcomes[operation['seq']]
+            if isinstance(outcome, Rejected):
+                connection.execute(
+                    "UPDATE operations SET rejected_at = ?, last_error = ? WHERE seq = ?",
+                    (now, str(outcome), operation['seq']),
+                )
+                continue
+            row = operation['row']
+            if outcome != operation['record_id']:
+                # Applied under another ID (see _apply)
+                row = [int(outcome), *row[1:]] if row else None
+            connection.execute(
+                "UPDATE operations SET applied_at = ?, last_error = NULL, record_id = ?, row = ? WHERE seq = ?",
+                (now, outcome, json.dumps(row, ensure_ascii=False) if row is not None else None, operation['seq']),
+            )
+
+
+def _flush():
+    operations = pending()
+    if not operations:
+        return 0
+    renamed = {}
+    try:
+        worksheet = sheets_client.get_worksheet(WORKSHEET)
+        rows = [row[:len(COLUMNS)] for row in worksheet.get_all_values()[1:]]
+        _send(worksheet, rows, operations, renamed)
+        return len(operations)
+    except Exception as e:
+        _record_failure(operations, e)
+        if not _invalid(e):
+            raise
+
+    # Google Sheets refused the batch: send the operations one at a time, so an invalid
+    # one holds back only the operations after it, and after MAX_ATTEMPTS not even those
+    for operation in operations:
+        try:
+            _send(worksheet, rows, [operation], renamed)
+        except Exception as e:
+            if _invalid(e) and operation['attempts'] + 1 >= MAX_ATTEMPTS:
+                _reject(operation, f"отклонено Google Sheets: {e}")
+                continue
+            raise
+    return len(operations)
+
+
+def start_flusher(interval=FLUSH_INTERVAL):
+    """Start the background thread that flushes pending operations (once per process)."""
+    global _flusher
+    with _lock:
+        if _flusher is not None and _flusher.is_alive():
+            return
+
+        def loop():
+            while True:
+                try:
+                    flush()
+                except Exception:
+                    # Kept in the journal and retried on the next round; shown on the page
+                    pass
+                _wake.wait(timeout=interval)
+                _wake.clear()
+
+        _flusher = threading.Thread(target=loop, name="sheets-write-flusher", daemon=True)
+        _flusher.start()